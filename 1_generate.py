@@ -1,9 +1,55 @@
+import argparse
+import glob
+import os
 import benchmark
 
+def shard_journal_path(journal_path, shard):
+    # one journal per shard, so shards run side by side never append to the same file
+    return journal_path if shard is None or journal_path is None else journal_path.replace(".jsonl", f".shard{shard.replace('/', 'of')}.jsonl")
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shard", default=None, help="generate only shard i of N, e.g. 0/4")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="align while generating and stop each prompt once its ratios converge")
+    parser.add_argument("--all-models", action="store_true",
+                        help="generate every workflow in data/workflow, keeping each server on one checkpoint")
+    args = parser.parse_args()
+
     model = "./data/workflow/lcm_sdxl.json" # can be changed
-    iterations = 1 # can be changed
+    iterations = 1 # samples per prompt, can be changed
+    batch_size = 1 # samples rendered per request, can be changed
+    concurrency = 16 # max in-flight requests to ComfyUI, can be changed
+    queue_depth = 8 # max prompts waiting in the ComfyUI queue, can be changed
+    seed = None # base seed, sharded runs derive all seeds from it (0 if unset)
     data_path="./data/"
-    ip = "http://127.0.0.1:8190/prompt"
-    for i in range(iterations):
-        benchmark.generate_image(model, ip, data_path)
\ No newline at end of file
+    manifest_path = "./data/manifest.sqlite" # compiled from data_path on first run, set to None to read the txt files
+    journal_path = "./journal/lcm_sdxl.jsonl" # rerunning resumes from here, set to None to disable
+    ip = "http://127.0.0.1:8190/prompt" # or a list of urls, one per ComfyUI instance
+    arranged_path = None # e.g. "./arranged/lcm", download images straight into the 2_dirbuild.py layout
+    if args.adaptive:
+        if args.shard is not None:
+            parser.error("--shard cannot be combined with --adaptive, every round aligns the images of all prompts on this host")
+        if journal_path is None:
+            parser.error("--adaptive needs journal_path, it is how each round skips the samples already generated")
+        model_name = "lcm" # the model name used by 2_dirbuild.py and 3_align.py
+        source_path = "your/T2I_model/output/path" # where ComfyUI saves the images
+        benchmark.adaptive_generate(model, ip, data_path, source_path, f"./arranged/{model_name}",
+                                    f"./aligned/{model_name}", model_name, journal_path,
+                                    min_samples=5, max_samples=40, step=5, threshold=0.05,
+                                    manifest_path=manifest_path, concurrency=concurrency, queue_depth=queue_depth)
+    elif args.all_models:
+        models = sorted(glob.glob("./data/workflow/*.json"))
+        weights = {} # relative seconds per image, e.g. {"sdxl.json": 8, "lcm_sdxl.json": 1}
+        model_names = {"lcm_sdxl.json": "lcm"} # workflow file -> model name of 2_dirbuild.py and 3_align.py, others keep their file name
+        # every model gets its own folder next to the one of the single model run
+        arranged_root = os.path.dirname(os.path.normpath(arranged_path)) if arranged_path is not None else None
+        benchmark.generate_models(models, ip, data_path, concurrency=concurrency, queue_depth=queue_depth,
+                                  samples=iterations, journal_path=shard_journal_path("./journal/all_models.jsonl", args.shard),
+                                  batch_size=batch_size, manifest_path=manifest_path, shard=args.shard,
+                                  seed=seed, weights=weights, arranged_path=arranged_root, model_names=model_names)
+    else:
+        benchmark.generate_image(model, ip, data_path, concurrency=concurrency, queue_depth=queue_depth,
+                                 samples=iterations, journal_path=shard_journal_path(journal_path, args.shard), batch_size=batch_size,
+                                 manifest_path=manifest_path, shard=args.shard, seed=seed,
+                                 arranged_path=arranged_path)
@@ -1,10 +1,30 @@
-from benchmark.generate import dir_build
+from benchmark.generate import dir_build, watch_images
+import argparse
 import os
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and organize images as generation writes them")
+    parser.add_argument("--idle-timeout", type=float, default=None,
+                        help="with --watch, stop after this many seconds without a new image")
+    args = parser.parse_args()
+
     model = "lcm" # the model name
     source_path = "your/T2I_model/output/path" # the result of generation
     target_path = f"./arranged/{model}" # the place to store
+    mode = "auto" # rename, hardlink, symlink or move; auto renames on one filesystem and symlinks across
+    workers = 8 # threads organizing files, raise it for network filesystems
+    layout = "dirs" # or "shards": one tar per prompt with an offset index, far fewer files for network storage
+    transcode = None # "JPEG" or "WEBP" stores a smaller copy for alignment instead, see tools/bench_ingest.py
+    keep_original = True # with transcode, leave the original in source_path or delete it
+    store_path = None # e.g. f"./store/{model}": store each distinct image once and index near-duplicates
     if not os.path.exists(target_path):
         os.makedirs(target_path)
-    dir_build(source_path, target_path)
\ No newline at end of file
+    options = dict(mode=mode, workers=workers, layout=layout, transcode=transcode,
+                   keep_original=keep_original, store_path=store_path)
+    if args.watch:
+        watch_images(source_path, target_path, idle_timeout=args.idle_timeout,
+                     subscribers=[lambda record: print(f"{record['status']}: {record['path']}")], **options)
+    else:
+        dir_build(source_path, target_path, **options)
\ No newline at end of file
@@ -1,5 +1,5 @@
 from benchmark.generate import dir_build
-from benchmark.internViT_pkg import process_all_subdirs_multi
+from benchmark.internViT_pkg import align_worker, process_all_subdirs_multi, reduce_queue
 import os
 import torchvision
 import transformers
@@ -11,7 +11,26 @@ if __name__ == "__main__":
     model = "lcm" # the model name
     image_path = f"./arranged/{model}"
     output_path = f"./aligned/{model}" # the alignment output path
+    store_path = None # the store_path given to 2_dirbuild.py, to reuse labels of duplicate images
+    batch_size = 1 # images labeled per generate call, 8 or more keeps a large GPU busy
+    question_mode = "history" # "fan_out" asks gender, race and age independently in one call per batch,
+                              # "score" ranks the candidate labels by likelihood and counts their probabilities
+    workers = 4 # processes decoding and tiling images ahead of the model, 0 loads them on the main thread
+    feature_cache_path = None # a directory for the vision features, so rerunning with new questions skips the image encoder
+    answer_cache_path = None # e.g. "./aligned/answers.sqlite", shared by all models so reruns and repeated images are not asked again
+    queue_path = None # e.g. f"./aligned/{model}/queue.sqlite", lets several copies of this script, on one host or on hosts
+                      # sharing the storage, split the prompt folders between them and take over those of crashed copies
+    worker_id = None # name of this copy in the queue, reuse it on restart to resume its log; hostname-pid by default
     if not os.path.exists(output_path):
         os.makedirs(output_path)
-    process_all_subdirs_multi(image_path, output_path, model)
+    if queue_path is None:
+        process_all_subdirs_multi(image_path, output_path, model, store_path=store_path, batch_size=batch_size,
+                                  question_mode=question_mode, workers=workers,
+                                  feature_cache_path=feature_cache_path, answer_cache_path=answer_cache_path)
+    else:
+        align_worker(queue_path, image_path, output_path, model, worker_id=worker_id, store_path=store_path,
+                     batch_size=batch_size, question_mode=question_mode, workers=workers,
+                     feature_cache_path=feature_cache_path, answer_cache_path=answer_cache_path)
+        # a copy only gets here once no folder is pending or leased, so each one writes the full result
+        reduce_queue(queue_path, output_path, model)
     print("finished")
\ No newline at end of file
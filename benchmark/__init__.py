@@ -5,4 +5,6 @@ from .evaluate import explicit
 from .evaluate import implicit
 
 from .generate import dir_build
-from .generate import generate_image
\ No newline at end of file
+from .generate import generate_image, generate_models
+
+from .adaptive import adaptive_generate
\ No newline at end of file
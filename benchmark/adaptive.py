@@ -0,0 +1,125 @@
+import json
+import math
+import os
+
+from .generate.dict_build import dir_build
+from .generate.generate import iter_jobs, load_prompt_set, report_summary
+from .generate.journal import GenerationJournal
+from .generate.manifest import prompt_key
+from .generate.submitter import submit_prompts
+from .internViT_pkg.counts import add_counts, new_stats
+from .internViT_pkg.internvl_multi_v import (load_model, process_images_in_directory,
+                                             process_multi_person_images_in_directory, stats_to_ratio)
+
+
+def wilson_half_width(count, total, z=1.96):
+    """Half width of the Wilson score interval of count/total; 1 when nothing was counted yet."""
+    if total == 0:
+        return 1.0
+    p = count / total
+    return z * math.sqrt(p * (1 - p) / total + z * z / (4 * total * total)) / (1 + z * z / total)
+
+
+def stats_half_width(stats, z=1.96):
+    # the widest interval over every label of gender, race and age
+    return max(wilson_half_width(count, sum(counts.values()), z)
+               for dimension, counts in stats.items() if dimension != "unknown" for count in counts.values())
+
+
+def align_new_images(directory, state, model, tokenizer, generation_config, multi):
+    """Align only the images in `directory` that earlier rounds have not seen and add them to `state`."""
+    if not os.path.isdir(directory):
+        return
+    filenames = [filename for filename in os.listdir(directory) if filename not in state["processed"]]
+    if not filenames:
+        return
+    if multi:
+        _, stats_left, stats_right, valid_image_count, _ = process_multi_person_images_in_directory(
+            directory, model, tokenizer, generation_config, filenames)
+        add_counts(state["stats"][0], stats_left)
+        add_counts(state["stats"][1], stats_right)
+    else:
+        _, stats, valid_image_count, _ = process_images_in_directory(
+            directory, model, tokenizer, generation_config, filenames)
+        add_counts(state["stats"][0], stats)
+    state["processed"].update(filenames)
+    state["valid"] += valid_image_count
+
+
+def save_results(states, output_path, model_name):
+    stats_ratio = {}
+    progress = {}
+    for key, state in states.items():
+        prompt_name = key.replace("_", " ")
+        if len(state["stats"]) == 2:
+            stats_ratio[prompt_name] = {"left": stats_to_ratio(state["stats"][0]),
+                                        "right": stats_to_ratio(state["stats"][1])}
+        else:
+            stats_ratio[prompt_name] = stats_to_ratio(state["stats"][0])
+        progress[prompt_name] = {"samples": state["samples"], "images": state["valid"],
+                                 "half_width": state["half_width"], "converged": state["converged"]}
+    with open(os.path.join(output_path, f"align_{model_name}.json"), "w") as file:
+        json.dump(stats_ratio, file, indent=4)
+    with open(os.path.join(output_path, f"adaptive_{model_name}.json"), "w") as file:
+        json.dump(progress, file, indent=4)
+
+
+def adaptive_generate(model, ip, data_path, source_path, target_path, output_path, model_name, journal_path,
+                      min_samples=5, max_samples=40, step=5, threshold=0.05, z=1.96,
+                      manifest_path=None, model_path=None, **submit_options):
+    """Generate and align in rounds, and stop sampling a prompt once its ratios have converged.
+
+    A sample is one image: every job renders exactly as many images as it journals samples,
+    whatever latent batch the workflow ships with, so `min_samples`, `step` and `max_samples`
+    count images per prompt text and the Wilson intervals are taken over those images.
+    Samples are counted per prompt text, so a folder of 20 prompt variants gets 20 images per
+    sample. Every round generates up to `step` more samples for each folder that is still
+    open, moves the new images into `target_path` with dir_build and aligns only those. A
+    folder is closed once it has `min_samples` and the widest Wilson interval on its gender,
+    race and age ratios is below +-`threshold`, or when it reaches `max_samples`.
+
+    Generation resumes from `journal_path`; alignment counts are rebuilt from the images
+    already in `target_path` on the first round after a restart. The journal is required:
+    each round asks for all samples up to its count, and the journal is what keeps the
+    samples of earlier rounds from being generated again.
+    """
+    if journal_path is None:
+        raise ValueError("adaptive_generate needs a journal_path, every round only submits the samples missing from it")
+    workflow_path = model
+    keys = sorted({prompt_key(prompt_text) for _, prompt_text in load_prompt_set(data_path, manifest_path)})
+    states = {}
+    for key in keys:
+        multi = key[0] == "O"
+        states[key] = {"stats": [new_stats() for _ in range(2 if multi else 1)],
+                       "processed": set(), "valid": 0, "samples": 0, "half_width": 1.0, "converged": False}
+    vlm, tokenizer, generation_config = load_model() if model_path is None else load_model(model_path)
+    os.makedirs(target_path, exist_ok=True)
+    os.makedirs(output_path, exist_ok=True)
+
+    samples = 0
+    with GenerationJournal(journal_path) as journal:
+        journal.reconcile()
+        while samples < max_samples:
+            active = {key for key, state in states.items() if not state["converged"]}
+            if not active:
+                break
+            samples = min(max(samples + step, min_samples), max_samples)
+            # batch_size 1 sets the workflow's latent batch to one image per sample, see iter_jobs
+            jobs = iter_jobs(workflow_path, data_path, samples=samples, journal=journal, batch_size=1,
+                             manifest_path=manifest_path, keys=active)
+            summary = submit_prompts(jobs, ip, on_submitted=journal.record_job, on_finished=journal.record_job,
+                                     **submit_options)
+            report_summary(summary)
+            dir_build(source_path, target_path)
+
+            for key in sorted(active):
+                state = states[key]
+                align_new_images(os.path.join(target_path, key), state, vlm, tokenizer, generation_config,
+                                 multi=len(state["stats"]) == 2)
+                state["samples"] = samples
+                state["half_width"] = max(stats_half_width(stats, z) for stats in state["stats"])
+                state["converged"] = samples >= min_samples and state["half_width"] <= threshold
+            save_results(states, output_path, model_name)
+            closed = sum(state["converged"] for state in states.values())
+            print(f"Round with {samples} samples per prompt done, {closed}/{len(states)} prompts converged")
+    return states
@@ -1,2 +1,8 @@
 from .dict_build import dir_build
-from .generate import generate_image
\ No newline at end of file
+from .generate import generate_image
+from .manifest import compile_manifest, PromptManifest
+from .submitter import submit_prompts
+from .scheduler import generate_models
+from .shards import ShardReader
+from .store import ImageStore
+from .watch import ImageWatcher, watch_images
@@ -1,24 +1,303 @@
+import json
 import os
 import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-def organize_images(source_dir, target_dir):
-    if not os.path.exists(target_dir):
-        os.makedirs(target_dir)
-    
-    for filename in os.listdir(source_dir):
+from PIL import Image, UnidentifiedImageError
 
-        if filename.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.bmp')):
+from .ingest import transcode_image, transcoded_name, write_atomic
+from .shards import append_to_shard, shard_path
+from .store import ImageStore
 
-            key = filename.split(',')[0]
-            folder_path = os.path.join(target_dir, key)
-            if not os.path.exists(folder_path):
-                os.makedirs(folder_path)
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')
+MODES = ("auto", "move", "rename", "hardlink", "symlink")
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_END = b'\x00\x00\x00\x00IEND\xaeB`\x82'
 
-            source_path = os.path.join(source_dir, filename)
-            target_path = os.path.join(folder_path, filename)
-            shutil.move(source_path, target_path)
-    print("finished")
+def check_image_header(path, size):
+    """Cheap check that an image is complete: its signature matches and it ends where the format says."""
+    if size < 16:
+        return False
+    with open(path, 'rb') as file:
+        head = file.read(16)
+        file.seek(max(size - 32, 0))
+        tail = file.read()
+    if head.startswith(PNG_SIGNATURE):
+        return head[12:16] == b'IHDR' and tail.endswith(PNG_END)
+    if head.startswith(b'\xff\xd8\xff'):
+        # some encoders pad after the end-of-image marker
+        return b'\xff\xd9' in tail
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return tail.endswith(b';')
+    if head.startswith(b'BM'):
+        return int.from_bytes(head[2:6], 'little') == size
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        return int.from_bytes(head[4:8], 'little') + 8 == size
+    return False
 
-def dir_build(source_directory, target_directory):
-    organize_images(source_directory, target_directory)
+def resolve_mode(mode, source_dir, target_dir):
+    if mode != "auto":
+        return mode
+    # a rename is free on the same filesystem, across filesystems it would copy every byte
+    same_device = os.stat(source_dir).st_dev == os.stat(target_dir).st_dev
+    return "rename" if same_device else "symlink"
 
+def place_file(source_path, target_path, mode):
+    if mode == "rename":
+        if os.path.exists(target_path):
+            raise FileExistsError(target_path)
+        os.rename(source_path, target_path)
+    elif mode == "hardlink":
+        os.link(source_path, target_path)
+    elif mode == "symlink":
+        os.symlink(os.path.abspath(source_path), target_path)
+    else:
+        if os.path.exists(target_path):
+            raise FileExistsError(target_path)
+        shutil.move(source_path, target_path)
+
+def transcode_entry(entry, transcode):
+    """Name and bytes of the alignment copy of `entry`; None when the image does not decode."""
+    try:
+        data = transcode_image(entry.path, transcode["max_side"], transcode["format"], transcode["quality"])
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError):
+        return None, None
+    return transcoded_name(entry.name, transcode["format"]), data
+
+def make_key_dir(target_dir, key, directories):
+    # made for the first image of a key that passes the check, a key whose files are all corrupt gets no folder
+    if key not in directories:
+        os.makedirs(os.path.join(target_dir, key), exist_ok=True)
+        directories.add(key)
+
+def organize_entry(entry, target_dir, mode, check, transcode=None, directories=None):
+    key = entry.name.split(',')[0]
+    stat = entry.stat()
+    record = {"path": os.path.join(key, entry.name), "key": key, "size": stat.st_size, "mtime": stat.st_mtime}
+    if check and not check_image_header(entry.path, stat.st_size):
+        # left where it is so it can be regenerated, the alignment stage never sees it
+        record.update(path=entry.path, status="corrupt")
+        return record
+    if transcode is not None:
+        name = transcoded_name(entry.name, transcode["format"])
+        target_path = os.path.join(target_dir, key, name)
+        record.update(path=os.path.join(key, name), source_size=stat.st_size, status="exists")
+        if not os.path.exists(target_path):
+            # kept originals are seen again on every run, only new ones are decoded
+            name, data = transcode_entry(entry, transcode)
+            if data is None:
+                record.update(path=entry.path, status="corrupt")
+                return record
+            make_key_dir(target_dir, key, set() if directories is None else directories)
+            write_atomic(target_path, data)
+            record.update(size=len(data), status="ok")
+        if not transcode["keep_original"]:
+            os.remove(entry.path)
+        return record
+    make_key_dir(target_dir, key, set() if directories is None else directories)
+    try:
+        place_file(entry.path, os.path.join(target_dir, key, entry.name), mode)
+        record["status"] = "ok"
+    except FileExistsError:
+        record["status"] = "exists"
+    return record
+
+def store_entry(entry, target_dir, check, transcode, store, directories=None):
+    # the file goes into the store and the arranged tree only links to it
+    key = entry.name.split(',')[0]
+    stat = entry.stat()
+    record = {"path": os.path.join(key, entry.name), "key": key, "size": stat.st_size, "mtime": stat.st_mtime}
+    if check and not check_image_header(entry.path, stat.st_size):
+        record.update(path=entry.path, status="corrupt")
+        return record
+    name, source_path = entry.name, entry.path
+    if transcode is not None:
+        name, data = transcode_entry(entry, transcode)
+        if data is None:
+            record.update(path=entry.path, status="corrupt")
+            return record
+        source_path = os.path.join(store.root, "incoming", name)
+        write_atomic(source_path, data)
+        record.update(path=os.path.join(key, name), size=len(data), source_size=stat.st_size)
+        if not transcode["keep_original"]:
+            os.remove(entry.path)
+    digest, object_path, stored = store.add_file(source_path, key)
+    make_key_dir(target_dir, key, set() if directories is None else directories)
+    store.place(digest, object_path, os.path.join(target_dir, key, name), key)
+    record.update(hash=digest, stored=stored, status="ok")
+    return record
+
+def organize_shard(key, entries, target_dir, check, transcode=None):
+    # one task per key, so no two threads ever append to the same tar
+    path = shard_path(target_dir, key)
+    records, files = [], []
+    for entry in entries:
+        stat = entry.stat()
+        record = {"path": os.path.join(os.path.basename(path), entry.name), "key": key,
+                  "size": stat.st_size, "mtime": stat.st_mtime}
+        if check and not check_image_header(entry.path, stat.st_size):
+            record.update(path=entry.path, status="corrupt")
+        elif transcode is not None:
+            name, data = transcode_entry(entry, transcode)
+            if data is None:
+                record.update(path=entry.path, status="corrupt")
+            else:
+                record.update(path=os.path.join(os.path.basename(path), name), size=len(data),
+                              source_size=stat.st_size)
+                files.append((name, data))
+        else:
+            files.append((entry.name, entry.path))
+        records.append(record)
+    # no empty shard for a key whose files are all corrupt
+    added = append_to_shard(path, files) if files else {}
+    for entry, record in zip(entries, records):
+        if "status" in record:
+            continue
+        name = os.path.basename(record["path"])
+        record["status"] = "ok" if name in added else "exists"
+        if name in added:
+            record["offset"] = added[name][0]
+        if transcode is None or not transcode["keep_original"]:
+            os.remove(entry.path)
+    return records
+
+def iter_batches(iterator, size):
+    batch = []
+    for item in iterator:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class Organizer:
+    """Places batches of image DirEntries into `target_dir`, see organize_images for the options.
+
+    Keeps the open manifest, thread pool, image store and counts across batches, so the same
+    placement runs for a whole directory at once or for files as they appear (watch.py).
+    """
+
+    def __init__(self, source_dir, target_dir, mode="auto", workers=8, manifest_path=None, check=True,
+                 layout="dirs", transcode=None, quality=90, max_side=896, keep_original=True, store_path=None,
+                 max_distance=4):
+        if mode not in MODES:
+            raise ValueError(f"unknown mode {mode!r}, expected one of {MODES}")
+        if layout not in ("dirs", "shards"):
+            raise ValueError(f"unknown layout {layout!r}, expected dirs or shards")
+        if store_path is not None and layout != "dirs":
+            raise ValueError("the image store links files into prompt folders, it needs layout='dirs'")
+        self.transcode = None
+        if transcode is not None:
+            self.transcode = {"format": transcode.upper(), "quality": quality, "max_side": max_side,
+                              "keep_original": keep_original}
+        if not os.path.exists(target_dir):
+            os.makedirs(target_dir)
+        self.target_dir = target_dir
+        self.mode = resolve_mode(mode, source_dir, target_dir)
+        self.check = check
+        self.layout = layout
+        self.directories = {entry.name for entry in os.scandir(target_dir) if entry.is_dir()}
+        self.counts = {"ok": 0, "exists": 0, "corrupt": 0}
+        self.store = None
+        if store_path is not None:
+            self.store = ImageStore(store_path, max_distance)
+            os.makedirs(os.path.join(store_path, "incoming"), exist_ok=True)
+            self.counts.update(new=0, duplicate=0, near_duplicate=0)
+        self.manifest = open(manifest_path or os.path.join(target_dir, "manifest.jsonl"), "a")
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.start_time = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown()
+        self.manifest.close()
+        if self.store is not None:
+            self.store.close()
+
+    def organize_entry(self, entry):
+        if self.store is not None:
+            return store_entry(entry, self.target_dir, self.check, self.transcode, self.store, self.directories)
+        return organize_entry(entry, self.target_dir, self.mode, self.check, self.transcode, self.directories)
+
+    def organize(self, entries):
+        """Place one batch of entries and return their manifest records."""
+        if self.layout == "shards":
+            groups = {}
+            for entry in entries:
+                groups.setdefault(entry.name.split(',')[0], []).append(entry)
+            records = [record for records in self.executor.map(
+                lambda group: organize_shard(*group, self.target_dir, self.check, self.transcode), groups.items())
+                for record in records]
+        else:
+            records = list(self.executor.map(self.organize_entry, entries))
+        for record in records:
+            self.counts[record["status"]] += 1
+            if "stored" in record:
+                self.counts[record["stored"]] += 1
+            self.manifest.write(json.dumps(record) + "\n")
+        self.manifest.flush()
+        return records
+
+    def report(self):
+        counts = self.counts
+        elapsed = time.monotonic() - self.start_time
+        method = self.mode if self.layout == "dirs" else "packing into shards"
+        if self.transcode is not None:
+            method = f"transcoding to {self.transcode['format']}"
+        print(f"finished: {counts['ok']} images organized by {method}, {counts['exists']} already in place, "
+              f"{counts['corrupt']} corrupt in {elapsed:.1f}s")
+        if self.store is not None:
+            print(f"store: {counts['new']} new, {counts['duplicate']} exact and {counts['near_duplicate']} near duplicates")
+            for entry in self.store.mode_collapse():
+                print(f"possible mode collapse: {entry['key']}, {entry['duplicate_ratio']:.0%} of "
+                      f"{entry['images']} images are copies")
+        return counts
+
+def is_image_entry(entry):
+    return entry.name.lower().endswith(IMAGE_EXTENSIONS) and entry.is_file()
+
+def organize_images(source_dir, target_dir, mode="auto", workers=8, manifest_path=None, check=True, batch=4096,
+                    layout="dirs", transcode=None, quality=90, max_side=896, keep_original=True, store_path=None,
+                    max_distance=4):
+    """Sort generated images into `target_dir`/<prompt key>/ on a thread pool.
+
+    `mode` is "rename", "hardlink", "symlink", "move" (shutil.move, copies across
+    filesystems) or "auto", which renames on the same filesystem and symlinks across.
+    Every file is logged to a JSONL manifest (`target_dir`/manifest.jsonl by default) with
+    its path relative to `target_dir`, prompt key, size, mtime and status; files failing
+    the header check are logged as "corrupt" and stay in `source_dir`.
+
+    With `layout="shards"`, the images of each prompt key are appended to one tar file,
+    `target_dir`/<prompt key>.tar, with an offset index next to it, and removed from
+    `source_dir` once packed; `mode` does not apply.
+
+    With `transcode="JPEG"` or `"WEBP"`, an alignment copy at most `max_side` pixels on its
+    long side is written at `quality` instead of the original, which is then left in
+    `source_dir` or deleted depending on `keep_original`; `mode` does not apply either.
+
+    With a `store_path`, images are moved into an ImageStore there and the arranged files
+    link to it, so exact duplicates are stored once and near-duplicates (dHash within
+    `max_distance` bits, same prompt) are indexed for label reuse at alignment; the prompts
+    that look mode-collapsed are printed at the end. Needs the "dirs" layout.
+    """
+    with Organizer(source_dir, target_dir, mode=mode, workers=workers, manifest_path=manifest_path, check=check,
+                   layout=layout, transcode=transcode, quality=quality, max_side=max_side,
+                   keep_original=keep_original, store_path=store_path, max_distance=max_distance) as organizer, \
+            os.scandir(source_dir) as entries:
+        # bounded batches keep millions of pending futures out of memory
+        for entries_batch in iter_batches((entry for entry in entries if is_image_entry(entry)), batch):
+            organizer.organize(entries_batch)
+        return organizer.report()
+
+def dir_build(source_directory, target_directory, mode="auto", workers=8, layout="dirs", transcode=None,
+              quality=90, max_side=896, keep_original=True, store_path=None):
+    return organize_images(source_directory, target_directory, mode=mode, workers=workers, layout=layout,
+                           transcode=transcode, quality=quality, max_side=max_side, keep_original=keep_original,
+                           store_path=store_path)
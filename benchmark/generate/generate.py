@@ -1,8 +1,15 @@
+import copy
 import json
 import os
 from urllib import request, parse
 import random
 
+from .journal import GenerationJournal, stable_prompt_id
+from .manifest import open_manifest, prompt_key
+from .sharding import SEED_MAX, SEED_MIN, derive_seed, parse_shard, shard_of
+from .sink import ImageSink
+from .submitter import submit_prompts
+
 def queue_prompt(prompt, ip):
     p = {"prompt": prompt}
     data = json.dumps(p).encode('utf-8')
@@ -30,31 +37,158 @@ def truncate_prompt(prompt):
         truncated = prompt
     return truncated
 
+def load_workflow(json_template):
+    with open(json_template, 'r') as file:
+        return json.load(file)
+
+def random_seed():
+    return random.randint(SEED_MIN, SEED_MAX)
+
+SEED_INPUTS = ("seed", "noise_seed")
+
+def workflow_nodes(workflow):
+    # "3"/"6"/"9" in the SDXL and cascade workflows, but pixart_sigma numbers its nodes differently,
+    # so take the first sampler, the text node wired to its positive input and the SaveImage node;
+    # every sampler gets the job's seed, stable_cascade has a second one for stage B
+    seed_nodes = [node_id for node_id, node in workflow.items() if any(name in node["inputs"] for name in SEED_INPUTS)]
+    text_node = workflow[seed_nodes[0]]["inputs"]["positive"][0]
+    save_node = next(node_id for node_id, node in workflow.items() if node["class_type"] == "SaveImage")
+    return text_node, save_node, seed_nodes
+
+def build_prompt(workflow, prompt_text, seed=None, tag=None):
+    prompt = copy.deepcopy(workflow)
+    text_node, save_node, seed_nodes = workflow_nodes(prompt)
+    prompt[text_node]["inputs"]["text"] = prompt_text
+    truncated_prompt = truncate_prompt(prompt_text)
+    if tag is not None:
+        # dir_build only keys on the text before the first comma, so a suffix keeps grouping intact
+        truncated_prompt = f"{truncated_prompt}_{tag}"
+    prompt[save_node]["inputs"]["filename_prefix"] = truncated_prompt
+    seed = random_seed() if seed is None else seed
+    for seed_node in seed_nodes:
+        for name in SEED_INPUTS:
+            if name in prompt[seed_node]["inputs"]:
+                prompt[seed_node]["inputs"][name] = seed
+    return prompt
+
+def set_batch_size(prompt, batch_size):
+    # the empty latent node is "5" in the SDXL workflows but not in pixart_sigma or stable_cascade
+    for node in prompt.values():
+        if "batch_size" in node["inputs"]:
+            node["inputs"]["batch_size"] = batch_size
+            return prompt
+    raise KeyError("workflow has no latent node with a batch_size input")
+
 def process_prompts(json_template, filename, ip):
-    prompts = load_prompts(filename)
-    for prompt_text in prompts:
-        with open(json_template, 'r') as file:
-          prompt = json.load(file)  
-        file.close()
-        prompt["6"]["inputs"]["text"] = prompt_text
-        truncated_prompt = truncate_prompt(prompt_text)
-        prompt["9"]["inputs"]["filename_prefix"] = truncated_prompt
-        prompt["3"]["inputs"]["seed"] = random.randint(1000, 6000000000)
+    workflow = load_workflow(json_template)
+    for prompt_text in load_prompts(filename):
+        prompt = build_prompt(workflow, prompt_text)
         response = queue_prompt(prompt, ip)
         print(f"Processed prompt: {prompt_text}, Response: {response}")
 
-def generate_image(model, ip, data_path):
-    workflow_path = model
+def list_prompt_files(data_path):
     prompt_path = os.path.join(data_path, "prompt")
+    prompt_files = []
     for sub_attr in os.listdir(prompt_path):
         if sub_attr != "relation":
             for txt_file in os.listdir(os.path.join(prompt_path, sub_attr)):
-                process_prompts(workflow_path, 
-                                os.path.join(prompt_path, os.path.join(sub_attr, txt_file)),
-                                ip)
+                prompt_files.append(os.path.join(prompt_path, sub_attr, txt_file))
         else:
             for sub_relation in os.listdir(os.path.join(prompt_path, sub_attr)):
-                for txt_file in os.listdir(os.path.join(os.path.join(prompt_path, sub_attr), sub_relation)):
-                    process_prompts(workflow_path, 
-                                    os.path.join(os.path.join(prompt_path, sub_attr), os.path.join(sub_relation, txt_file)),
-                                    ip)                    
\ No newline at end of file
+                for txt_file in os.listdir(os.path.join(prompt_path, sub_attr, sub_relation)):
+                    prompt_files.append(os.path.join(prompt_path, sub_attr, sub_relation, txt_file))
+    return prompt_files
+
+def load_prompt_set(data_path, manifest_path=None):
+    """Return (prompt id, prompt text) pairs, from the compiled manifest when one is given."""
+    if manifest_path is None:
+        return [(stable_prompt_id(prompt_text), prompt_text)
+                for filename in list_prompt_files(data_path) for prompt_text in load_prompts(filename)]
+    with open_manifest(data_path, manifest_path) as manifest:
+        return [(row["id"], row["text"]) for row in manifest]
+
+def iter_jobs(workflow_path, data_path, samples=1, journal=None, batch_size=1, manifest_path=None,
+              shard=None, seed=None, keys=None):
+    # the workflow is parsed once and copied per prompt instead of re-read from disk
+    workflow = load_workflow(workflow_path)
+    workflow_name = os.path.basename(workflow_path)
+    prompt_set = load_prompt_set(data_path, manifest_path)
+    if keys is not None:
+        prompt_set = [(prompt_id, prompt_text) for prompt_id, prompt_text in prompt_set if prompt_key(prompt_text) in keys]
+    shard_index, shard_count = parse_shard(shard) if shard is not None else (0, 1)
+    deterministic = shard is not None or seed is not None
+    partial_blocks = 0
+    # each job renders up to `batch_size` samples of one prompt from a single latent batch,
+    # so text encoding and the request are paid once per batch instead of once per image
+    for batch_start in range(0, samples, batch_size):
+        block = batch_start // batch_size
+        batch_samples = list(range(batch_start, min(batch_start + batch_size, samples)))
+        for prompt_id, prompt_text in prompt_set:
+            if shard_count > 1 and shard_of(prompt_id, block, shard_count) != shard_index:
+                continue
+            missing = [sample for sample in batch_samples
+                       if journal is None or not journal.is_done(workflow_name, prompt_id, sample)]
+            if not missing:
+                continue
+            if deterministic:
+                # ComfyUI draws the noise of a whole batch from one seed, so a block is only
+                # reproducible when it is rendered whole with the seed derived for it; rendering
+                # a partly done block again would add copies of its done samples to the prompt folder
+                if len(missing) < len(batch_samples):
+                    partial_blocks += 1
+                    continue
+                job_seed = derive_seed(prompt_id, block, seed or 0)
+                prompt = build_prompt(workflow, prompt_text, job_seed, tag=f"{prompt_id}-{block:04d}")
+            else:
+                job_seed = random_seed()
+                prompt = build_prompt(workflow, prompt_text, job_seed)
+            # also at batch_size 1: most workflows ship with a latent batch of 8 or 16, which would
+            # render that many images for every journaled sample
+            set_batch_size(prompt, len(missing))
+            yield {"text": prompt_text, "prompt": prompt,
+                   "workflow": workflow_name, "id": prompt_id, "samples": missing, "seed": job_seed}
+    if partial_blocks:
+        print(f"Skipped {partial_blocks} partly done sample blocks: with derived seeds a block can only be rendered whole, "
+              f"which would duplicate its done samples. They come from a change of batch_size or samples since the "
+              f"journaled run; keep the old values, or use a new seed or journal, to complete them")
+
+def report_summary(summary):
+    print(f"Submitted {summary['submitted']} prompts, {summary['completed']} completed, {summary['failed']} failed")
+    if summary["images"]:
+        print(f"Generated {summary['images']} images in {summary['elapsed']:.1f}s "
+              f"({summary['images_per_sec']:.2f} images/s), "
+              f"latency p50 {summary['latency_p50']:.2f}s, p99 {summary['latency_p99']:.2f}s")
+    for url, completed in summary.get("endpoints", {}).items():
+        print(f"  {url}: {completed} prompts completed")
+
+# `ip` is a single ComfyUI /prompt url or a list of them, one per ComfyUI instance.
+# With a `journal_path`, every sample is logged as it is submitted and finished, and
+# a restarted run only submits the samples that are not done yet. A `batch_size` above 1
+# renders that many samples of a prompt per request. With a `manifest_path`, prompts are
+# read from the compiled manifest, which is built from `data_path` on first use.
+# `shard="i/N"` keeps only the (prompt, sample block) pairs that hash to shard i of N and
+# derives every seed from the prompt id, block and `seed`, so any shard can be re-run
+# with identical output and shards merge in dir_build without filename collisions.
+# With an `arranged_path`, finished images are downloaded from ComfyUI into the layout
+# dir_build would build there, so 2_dirbuild.py does not need to run afterwards.
+def generate_image(model, ip, data_path, concurrency=16, retries=3, queue_depth=8, track=True,
+                   samples=1, journal_path=None, batch_size=1, manifest_path=None, shard=None, seed=None,
+                   arranged_path=None):
+    workflow_path = model
+    journal = GenerationJournal(journal_path) if journal_path is not None else None
+    hooks = {}
+    if journal is not None:
+        journal.reconcile(downloads=arranged_path is not None)
+        hooks = {"on_submitted": journal.record_job, "on_finished": journal.record_job}
+    try:
+        jobs = iter_jobs(workflow_path, data_path, samples=samples, journal=journal, batch_size=batch_size,
+                         manifest_path=manifest_path, shard=shard, seed=seed)
+        sink = ImageSink(arranged_path) if arranged_path is not None else None
+        summary = submit_prompts(jobs, ip,
+                                 concurrency=concurrency, retries=retries,
+                                 queue_depth=queue_depth, track=track, sink=sink, **hooks)
+    finally:
+        if journal is not None:
+            journal.close()
+    report_summary(summary)
+    return summary
@@ -0,0 +1,34 @@
+import io
+import os
+
+from PIL import Image
+
+FORMATS = {"JPEG": ".jpg", "WEBP": ".webp"}
+
+
+def transcode_image(source_path, max_side=896, fmt="JPEG", quality=90):
+    """Decode an image, shrink it to at most `max_side` pixels on its long side and re-encode it.
+
+    The alignment stage resizes every image to a 3x2 grid of 448 pixel tiles (1344x896) plus
+    a 448 pixel thumbnail, so the default keeps the short side it actually samples from.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown format {fmt!r}, expected one of {sorted(FORMATS)}")
+    with Image.open(source_path) as image:
+        image = image.convert("RGB")
+        if max(image.size) > max_side:
+            image.thumbnail((max_side, max_side), Image.BICUBIC)
+        buffer = io.BytesIO()
+        image.save(buffer, fmt, quality=quality)
+    return buffer.getvalue()
+
+
+def transcoded_name(filename, fmt="JPEG"):
+    return os.path.splitext(filename)[0] + FORMATS[fmt]
+
+
+def write_atomic(path, data):
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.part")
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+    os.replace(tmp_path, path)
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import sys
+from urllib import error, request
+
+
+def stable_prompt_id(prompt_text):
+    """Id of a prompt that stays the same across runs, machines and prompt file orderings."""
+    return hashlib.sha1(prompt_text.encode("utf-8")).hexdigest()[:16]
+
+
+class GenerationJournal:
+    """Append-only JSONL log of every (workflow, prompt id, sample index) submitted to ComfyUI.
+
+    Each line is one status change; the latest line for a key wins. The whole log is folded
+    into a compact key -> status dict when opened, so `status` is a single lookup however
+    long the run has been; the rest of a record (seed, ComfyUI prompt id, endpoint) is only
+    kept for samples still "submitted", which are the ones `reconcile` has to look up.
+    A sample counts as done once it is "success" or still "submitted" to a live server.
+    """
+
+    DONE = ("success", "submitted")
+    KEY_FIELDS = ("workflow", "prompt", "sample", "status")
+
+    def __init__(self, path):
+        self.path = path
+        self.statuses = {}
+        self.pending = {}
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # a line cut short by a crash
+                    self.fold(record)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, "a")
+
+    def fold(self, record):
+        # interned, so the millions of keys of a long run share one copy of each workflow, prompt id and status
+        key = (sys.intern(record["workflow"]), sys.intern(record["prompt"]), record["sample"])
+        status = sys.intern(record["status"])
+        self.statuses[key] = status
+        if status == "submitted":
+            self.pending[key] = {field: value for field, value in record.items() if field not in self.KEY_FIELDS}
+        else:
+            self.pending.pop(key, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def __len__(self):
+        return len(self.statuses)
+
+    def status(self, workflow, prompt, sample):
+        return self.statuses.get((workflow, prompt, sample))
+
+    def is_done(self, workflow, prompt, sample):
+        return self.status(workflow, prompt, sample) in self.DONE
+
+    def record(self, workflow, prompt, sample, seed, status, **extra):
+        record = {"workflow": workflow, "prompt": prompt, "sample": sample, "seed": seed, "status": status}
+        record.update(extra)
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        self.fold(record)
+
+    def record_job(self, job):
+        """Log the status of every sample in `job`; a batched job shares one seed across its samples."""
+        extra = {}
+        if job.get("prompt_id"):
+            extra["comfy_prompt_id"] = job["prompt_id"]
+            extra["endpoint"] = job["endpoint"]
+        for batch_index, sample in enumerate(job["samples"]):
+            self.record(job["workflow"], job["id"], sample, job["seed"], job["status"],
+                        batch_index=batch_index, **extra)
+
+    def reconcile(self, timeout=10, downloads=False):
+        """Settle samples left "submitted" by a crashed run against the servers they went to.
+
+        Backpressure bounds these to queue_depth per endpoint, so asking each server directly
+        is cheap. Prompts the server finished are recorded with their final status, prompts it
+        still has queued are left alone, and prompts it no longer knows are marked "lost" so
+        the next run submits them again. With `downloads`, a run that streams images into the
+        arranged tree, the images of a prompt finished after the crash were never downloaded,
+        so its samples are marked "undownloaded" and submitted again as well.
+        """
+        queues = {}
+        histories = {}
+        unreachable = set()  # a dead server costs one timeout, not one per sample sent to it
+        for (workflow, prompt, sample), record in list(self.pending.items()):
+            endpoint, comfy_id = record.get("endpoint"), record.get("comfy_prompt_id")
+            extra = {key: value for key, value in record.items() if key != "seed"}
+            if endpoint in unreachable:
+                self.record(workflow, prompt, sample, record["seed"], "lost", **extra)
+                continue
+            try:
+                if comfy_id not in histories:
+                    with request.urlopen(f"{endpoint}/history/{comfy_id}", timeout=timeout) as response:
+                        histories[comfy_id] = json.loads(response.read()).get(comfy_id)
+                entry = histories[comfy_id]
+                if entry:
+                    status = entry.get("status", {}).get("status_str", "success")
+                    if downloads and status == "success":
+                        status = "undownloaded"
+                    self.record(workflow, prompt, sample, record["seed"], status, **extra)
+                    continue
+                if endpoint not in queues:
+                    with request.urlopen(f"{endpoint}/queue", timeout=timeout) as response:
+                        queue = json.loads(response.read())
+                    queues[endpoint] = {item[1] for item in queue.get("queue_running", []) + queue.get("queue_pending", [])}
+                if comfy_id in queues[endpoint]:
+                    continue
+            except (error.URLError, OSError):
+                unreachable.add(endpoint)
+            except ValueError:
+                pass
+            self.record(workflow, prompt, sample, record["seed"], "lost", **extra)
@@ -0,0 +1,190 @@
+import json
+import os
+import re
+import sqlite3
+
+from .journal import stable_prompt_id
+
+# protected attribute as written in the prompts -> (dimension, canonical label used in the truth files)
+ATTRIBUTES = {
+    "male": ("gender", "male"), "female": ("gender", "female"),
+    "man": ("gender", "male"), "woman": ("gender", "female"),
+    "white": ("race", "White"), "black": ("race", "Black"),
+    "east asian": ("race", "East Asian"), "south asian": ("race", "South Asian"),
+    "young": ("age", "0-30"), "middle-aged": ("age", "30-60"), "elderly": ("age", "60+"),
+}
+CATEGORIES = {"oc": "occupation", "char": "characteristic", "sr": "relation"}
+
+_ATTR = "|".join(sorted((re.escape(attribute) for attribute in ATTRIBUTES), key=len, reverse=True))
+OCCUPATION_RE = re.compile(rf"^a photo of one\s+(?:({_ATTR})\s+)?(.+)$", re.IGNORECASE)
+CHARACTERISTIC_RE = re.compile(rf"^a photo of an?\s+(\S+)\s+(?:(?:({_ATTR})\s+)?person|(man|woman))$", re.IGNORECASE)
+RELATION_RE = re.compile(rf"^One\s+(?:({_ATTR})\s+)?(.+?)\s+at left with (?:one|another)\s+(?:({_ATTR})\s+)?(.+?)\s+at right$",
+                         re.IGNORECASE)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS prompts (
+    id TEXT PRIMARY KEY,
+    text TEXT NOT NULL,
+    key TEXT NOT NULL,
+    category TEXT NOT NULL,
+    implicit INTEGER NOT NULL,
+    subject TEXT,
+    subject_group TEXT,
+    dimension TEXT,
+    attribute TEXT,
+    left_role TEXT,
+    left_attribute TEXT,
+    right_role TEXT,
+    right_attribute TEXT,
+    source TEXT NOT NULL,
+    line INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS prompts_key ON prompts (key);
+CREATE INDEX IF NOT EXISTS prompts_category ON prompts (category, implicit);
+"""
+COLUMNS = ("id", "text", "key", "category", "implicit", "subject", "subject_group", "dimension", "attribute",
+           "left_role", "left_attribute", "right_role", "right_attribute", "source", "line")
+
+
+def prompt_key(prompt_text):
+    # the part dir_build groups images by and the alignment stage reports ratios for
+    return prompt_text.split(',')[0]
+
+
+def _attribute(word):
+    return ATTRIBUTES[word.lower()] if word else (None, None)
+
+
+def parse_prompt(prompt_text, category, subject_groups=None):
+    """Split a prompt into the structured fields stored in the manifest."""
+    key = prompt_key(prompt_text)
+    row = dict.fromkeys(COLUMNS)
+    row.update({"id": stable_prompt_id(prompt_text), "text": prompt_text, "key": key, "category": category})
+    dimensions = []
+    if category == "occupation":
+        match = OCCUPATION_RE.match(key)
+        if match:
+            dimension, row["attribute"] = _attribute(match.group(1))
+            row["subject"] = match.group(2)
+            dimensions.append(dimension)
+    elif category == "characteristic":
+        match = CHARACTERISTIC_RE.match(key)
+        if match:
+            row["subject"] = match.group(1)
+            dimension, row["attribute"] = _attribute(match.group(2) or match.group(3))
+            dimensions.append(dimension)
+    elif category == "relation":
+        match = RELATION_RE.match(key)
+        if match:
+            left_dimension, row["left_attribute"] = _attribute(match.group(1))
+            right_dimension, row["right_attribute"] = _attribute(match.group(3))
+            row["left_role"], row["right_role"] = match.group(2), match.group(4)
+            row["subject"] = row["left_role"]
+            dimensions.extend([left_dimension, right_dimension])
+    dimensions = [dimension for dimension in dimensions if dimension]
+    row["dimension"] = dimensions[0] if dimensions else None
+    row["implicit"] = int(not dimensions)
+    if subject_groups and row["subject"]:
+        row["subject_group"] = subject_groups.get(_normalize_subject(row["subject"]))
+    return row
+
+
+def _normalize_subject(subject):
+    # category.json mixes singular and plural names ("Dentists", "Bartenders") and casing
+    subject = subject.lower()
+    return subject[:-1] if subject.endswith("s") else subject
+
+
+def load_subject_groups(data_path):
+    category_path = os.path.join(data_path, "truth", "category.json")
+    if not os.path.exists(category_path):
+        return {}
+    with open(category_path, "r") as file:
+        categories = json.load(file)
+    return {_normalize_subject(subject): group for group, subjects in categories.items() for subject in subjects}
+
+
+def compile_manifest(data_path, manifest_path):
+    """Parse every prompt file under `data_path`/prompt once and store the result in SQLite."""
+    from .generate import list_prompt_files, load_prompts
+
+    subject_groups = load_subject_groups(data_path)
+    prompt_root = os.path.join(data_path, "prompt")
+    rows = {}
+    for filename in sorted(list_prompt_files(data_path)):
+        category = CATEGORIES.get(os.path.basename(filename).split("_")[0].split(".")[0].strip())
+        if category is None:
+            continue
+        source = os.path.relpath(filename, prompt_root)
+        for line, prompt_text in enumerate(load_prompts(filename)):
+            row = parse_prompt(prompt_text, category, subject_groups)
+            row["source"], row["line"] = source, line
+            rows.setdefault(row["id"], row)
+
+    tmp_path = manifest_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    connection = sqlite3.connect(tmp_path)
+    with connection:
+        connection.executescript(SCHEMA)
+        connection.executemany(f"INSERT INTO prompts VALUES ({', '.join('?' * len(COLUMNS))})",
+                               [tuple(row[column] for column in COLUMNS) for row in rows.values()])
+    connection.close()
+    os.replace(tmp_path, manifest_path)
+    print(f"Compiled {len(rows)} prompts into {manifest_path}")
+    return manifest_path
+
+
+class PromptManifest:
+    """Read access to a compiled manifest; prompts come back as dicts keyed by column name."""
+
+    def __init__(self, manifest_path):
+        self.connection = sqlite3.connect(manifest_path)
+        self.connection.row_factory = sqlite3.Row
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM prompts").fetchone()[0]
+
+    def __iter__(self):
+        for row in self.connection.execute("SELECT * FROM prompts ORDER BY source, line"):
+            yield dict(row)
+
+    def get(self, prompt_id):
+        row = self.connection.execute("SELECT * FROM prompts WHERE id = ?", (prompt_id,)).fetchone()
+        return dict(row) if row else None
+
+    def by_key(self, key):
+        return [dict(row) for row in self.connection.execute("SELECT * FROM prompts WHERE key = ?", (key,))]
+
+    def select(self, **filters):
+        unknown = set(filters) - set(COLUMNS)
+        if unknown:
+            raise KeyError(f"unknown manifest columns: {sorted(unknown)}")
+        where = " AND ".join(f"{column} = ?" for column in filters)
+        query = "SELECT * FROM prompts" + (f" WHERE {where}" if where else "") + " ORDER BY source, line"
+        return [dict(row) for row in self.connection.execute(query, tuple(filters.values()))]
+
+
+def manifest_is_stale(data_path, manifest_path):
+    from .generate import list_prompt_files
+
+    if not os.path.exists(manifest_path):
+        return True
+    manifest_mtime = os.path.getmtime(manifest_path)
+    return any(os.path.getmtime(filename) > manifest_mtime for filename in list_prompt_files(data_path))
+
+
+def open_manifest(data_path, manifest_path):
+    """Open the manifest, compiling it again first if any prompt file was edited since."""
+    if manifest_is_stale(data_path, manifest_path):
+        compile_manifest(data_path, manifest_path)
+    return PromptManifest(manifest_path)
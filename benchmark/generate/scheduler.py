@@ -0,0 +1,176 @@
+import asyncio
+import os
+import time
+
+from .generate import iter_jobs, load_prompt_set, report_summary
+from .journal import GenerationJournal
+from .sink import ImageSink
+from .submitter import summarize_run, submit_prompts_async
+
+# workflow file -> the model name 2_dirbuild.py, 3_align.py and 4_evaluate.py use for its folders;
+# workflows not listed keep their file name without the extension
+MODEL_NAMES = {"lcm_sdxl.json": "lcm"}
+
+
+class WorkflowQueue:
+    """The jobs of one workflow, shared by every server currently rendering it.
+
+    `estimate` is the number of images the workflow renders and `weight` its time per image.
+    """
+
+    def __init__(self, path, jobs, estimate, weight=1.0, sink=None):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.jobs = jobs
+        self.estimate = estimate
+        self.weight = weight
+        self.sink = sink
+        self.taken = 0
+        self.images = 0
+        self.exhausted = False
+        self.servers = set()
+
+    def remaining_cost(self):
+        return 0.0 if self.exhausted else max(self.estimate - self.images, 1) * self.weight
+
+    def take(self, stint):
+        # pulled one job at a time, so servers sharing a workflow split it as fast as each one drains
+        while not stint["stop"]:
+            job = next(self.jobs, None)
+            if job is None:
+                self.exhausted = True
+                return
+            self.taken += 1
+            self.images += len(job["samples"])
+            yield job
+
+
+def pick_workflow(queues):
+    """The unfinished workflow with the most estimated work left per server rendering it."""
+    open_queues = [queue for queue in queues if not queue.exhausted]
+    if not open_queues:
+        return None
+    return max(open_queues, key=lambda queue: queue.remaining_cost() / (len(queue.servers) + 1))
+
+
+def assign_servers(ips, queues):
+    """Pin servers to workflows: every workflow gets one before any gets a second, costliest first."""
+    assignment = {}
+    for ip in ips:
+        unserved = [queue for queue in queues if not queue.servers and not queue.exhausted]
+        queue = max(unserved, key=lambda queue: queue.remaining_cost()) if unserved else pick_workflow(queues)
+        if queue is None:
+            break
+        queue.servers.add(ip)
+        assignment[ip] = queue
+    return assignment
+
+
+async def run_server(ip, queue, queues, stats, options, max_failures=3):
+    """Render `queue` on `ip` until it runs dry, then move to the workflow that needs help most.
+
+    Every move is one checkpoint load on that server. A server that fails `max_failures`
+    jobs in a row stops taking work, so a dead server does not drain the shared queues.
+    """
+    on_submitted = options.pop("on_submitted", None)
+    on_finished = options.pop("on_finished", None)
+    loads = []
+    while queue is not None:
+        loads.append(queue.name)
+        stint = {"stop": False, "failures": 0}
+
+        def finished(job, stint=stint):
+            if job["status"] == "success":
+                stint["failures"] = 0
+                stats["finished"].append(job)
+            else:
+                stint["failures"] += 1
+                stint["stop"] = stint["failures"] >= max_failures
+                if "latency" in job:
+                    stats["finished"].append(job)
+                else:
+                    stats["failed"] += 1
+            if on_finished is not None:
+                on_finished(job)
+
+        def submitted(job):
+            stats["submitted"] += 1
+            if on_submitted is not None:
+                on_submitted(job)
+
+        await submit_prompts_async(queue.take(stint), ip, on_submitted=submitted, on_finished=finished,
+                                   sink=queue.sink, **options)
+        queue.servers.discard(ip)
+        if stint["stop"]:
+            print(f"Server {ip} stopped after {max_failures} failed jobs in a row")
+            break
+        queue = pick_workflow(queues)
+        if queue is not None:
+            queue.servers.add(ip)
+            print(f"Server {ip} moves to {queue.name}")
+    stats["loads"][ip] = loads
+
+
+async def schedule_workflows_async(queues, ips, **options):
+    if isinstance(ips, str):
+        ips = [ips]
+    stats = {"submitted": 0, "failed": 0, "finished": [], "loads": {}}
+    start_time = time.monotonic()
+    assignment = assign_servers(ips, queues)
+    for ip, queue in assignment.items():
+        print(f"Server {ip} starts on {queue.name}")
+    await asyncio.gather(*(run_server(ip, queue, queues, stats, dict(options)) for ip, queue in assignment.items()))
+    summary = summarize_run(stats["finished"], stats["submitted"], stats["failed"], time.monotonic() - start_time)
+    summary["loads"] = stats["loads"]
+    summary["workflows"] = {}
+    for queue in queues:
+        jobs = [job for job in stats["finished"] if job["workflow"] == queue.name]
+        summary["workflows"][queue.name] = {"jobs": queue.taken,
+                                            "completed": sum(job["status"] == "success" for job in jobs)}
+    return summary
+
+
+# Renders several workflows over one pool of ComfyUI servers with as few checkpoint swaps as
+# possible: each server is pinned to one workflow and only moves to another once its own has
+# run out of jobs, so it loads each checkpoint at most once. `weights` maps a workflow file name
+# to its relative render time per image (e.g. {"sdxl.json": 8, "lcm_sdxl.json": 1}); servers are
+# split in proportion to the estimated work left. All workflows share one journal, whose entries
+# are keyed by workflow, so a restarted run resumes every model where it stopped. With an
+# `arranged_path`, the images of each workflow are downloaded into `arranged_path`/<model name>, where
+# `model_names` (default MODEL_NAMES) maps a workflow file name to the model name of the later steps.
+def generate_models(models, ip, data_path, concurrency=16, retries=3, queue_depth=8, samples=1,
+                    journal_path=None, batch_size=1, manifest_path=None, shard=None, seed=None, weights=None,
+                    arranged_path=None, model_names=None):
+    weights = weights or {}
+    model_names = MODEL_NAMES if model_names is None else model_names
+    journal = GenerationJournal(journal_path) if journal_path is not None else None
+    hooks = {}
+    if journal is not None:
+        journal.reconcile(downloads=arranged_path is not None)
+        hooks = {"on_submitted": journal.record_job, "on_finished": journal.record_job}
+    try:
+        prompt_count = len(load_prompt_set(data_path, manifest_path))
+        queues = []
+        for workflow_path in models:
+            jobs = iter_jobs(workflow_path, data_path, samples=samples, journal=journal, batch_size=batch_size,
+                             manifest_path=manifest_path, shard=shard, seed=seed)
+            # images, as the weights are per image; an upper bound, resumed and sharded runs render
+            # fewer, which only shifts the split
+            estimate = prompt_count * samples
+            name = os.path.basename(workflow_path)
+            sink = None
+            if arranged_path is not None:
+                model_name = model_names.get(name, os.path.splitext(name)[0])
+                sink = ImageSink(os.path.join(arranged_path, model_name))
+            queues.append(WorkflowQueue(workflow_path, jobs, estimate, weights.get(name, 1.0), sink))
+        summary = asyncio.run(schedule_workflows_async(queues, ip, concurrency=concurrency, retries=retries,
+                                                       queue_depth=queue_depth, **hooks))
+    finally:
+        if journal is not None:
+            journal.close()
+    report_summary(summary)
+    for name, counts in summary["workflows"].items():
+        print(f"  {name}: {counts['completed']}/{counts['jobs']} prompts completed")
+    for url, loads in summary["loads"].items():
+        print(f"  {url}: loaded {' -> '.join(loads)}")
+    return summary
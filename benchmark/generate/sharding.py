@@ -0,0 +1,28 @@
+import hashlib
+
+SEED_MIN = 1000
+SEED_MAX = 6000000000
+
+
+def parse_shard(shard):
+    """Turn "i/N" (or an (i, N) pair) into (i, N) with 0 <= i < N."""
+    if isinstance(shard, str):
+        index, count = (int(part) for part in shard.split("/"))
+    else:
+        index, count = shard
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"invalid shard {shard!r}, expected i/N with 0 <= i < N")
+    return index, count
+
+
+def _digest(*parts):
+    return int(hashlib.sha256(":".join(str(part) for part in parts).encode("utf-8")).hexdigest()[:16], 16)
+
+
+def shard_of(prompt_id, block, count):
+    # hash the (prompt, sample block) pair so every machine agrees without talking to the others
+    return _digest("shard", prompt_id, block) % count
+
+
+def derive_seed(prompt_id, block, base_seed=0):
+    return SEED_MIN + _digest("seed", base_seed, prompt_id, block) % (SEED_MAX - SEED_MIN + 1)
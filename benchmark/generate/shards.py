@@ -0,0 +1,106 @@
+import io
+import json
+import mmap
+import os
+import tarfile
+import time
+
+SHARD_EXTENSION = ".tar"
+INDEX_EXTENSION = ".idx"
+
+
+def is_shard(path):
+    return path.endswith(SHARD_EXTENSION) and os.path.isfile(path)
+
+
+def shard_path(target_dir, key):
+    return os.path.join(target_dir, key + SHARD_EXTENSION)
+
+
+def index_path(path):
+    return path + INDEX_EXTENSION
+
+
+def load_index(path):
+    """{image id: [data offset, size]} of a shard, rebuilt from the tar headers when the index is missing."""
+    try:
+        with open(index_path(path), "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        with tarfile.open(path, "r") as tar:
+            return {member.name: [member.offset_data, member.size] for member in tar if member.isfile()}
+
+
+def write_index(path, index):
+    tmp_path = index_path(path) + ".tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(index, file)
+    os.replace(tmp_path, index_path(path))
+
+
+def append_to_shard(path, files):
+    """Append (image id, source path or bytes) pairs to the tar shard at `path` and update its offset index.
+
+    Plain uncompressed tar, so the shard is still readable with `tar` or webdataset, while
+    the index lets readers seek straight to an image. Ids already in the shard are skipped.
+    Returns the {image id: [offset, size]} entries that were added.
+    """
+    index = load_index(path) if os.path.exists(path) else {}
+    added = {}
+    with tarfile.open(path, "a" if os.path.exists(path) else "w", format=tarfile.PAX_FORMAT) as tar:
+        for name, source in files:
+            if name in index or name in added:
+                continue
+            if isinstance(source, bytes):
+                data, mtime = source, time.time()
+            else:
+                with open(source, "rb") as file:
+                    data = file.read()
+                mtime = os.stat(source).st_mtime
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = mtime
+            # long prompt names add pax headers, so the data starts after the whole header block
+            header = info.tobuf(tar.format, tar.encoding, tar.errors)
+            added[name] = [tar.offset + len(header), len(data)]
+            tar.addfile(info, io.BytesIO(data))
+    index.update(added)
+    write_index(path, index)
+    return added
+
+
+class ShardReader:
+    """Random access to the images of one shard through a read-only memory map."""
+
+    def __init__(self, path):
+        self.path = path
+        self.index = load_index(path)
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def names(self):
+        # in file order, so a full pass reads the shard sequentially
+        return sorted(self.index, key=lambda name: self.index[name][0])
+
+    def read(self, name):
+        offset, size = self.index[name]
+        return self.map[offset:offset + size]
+
+    def open(self, name):
+        return io.BytesIO(self.read(name))
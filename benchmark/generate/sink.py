@@ -0,0 +1,73 @@
+import asyncio
+import os
+import random
+
+import aiohttp
+
+from .manifest import prompt_key
+
+
+class ImageSink:
+    """Streams finished images from ComfyUI's /view into `target_dir`/<prompt key>/.
+
+    This is the layout dir_build produces, so the arranged tree is filled while generating
+    and the separate move pass over ComfyUI's output directory is not needed. Every image is
+    written to a hidden temporary file next to its target and renamed into place, so a
+    crash never leaves a truncated image for the alignment stage to pick up.
+    """
+
+    def __init__(self, target_dir, retries=3, backoff=0.5, chunk_size=1 << 16):
+        self.target_dir = target_dir
+        self.retries = retries
+        self.backoff = backoff
+        self.chunk_size = chunk_size
+        self.directories = set()
+        self.reserved = set()
+        self.saved = 0
+        self.bytes = 0
+
+    def target_path(self, job, image, index):
+        folder_path = os.path.join(self.target_dir, prompt_key(job["text"]))
+        if folder_path not in self.directories:
+            os.makedirs(folder_path, exist_ok=True)
+            self.directories.add(folder_path)
+        filename = image["filename"]
+        path = os.path.join(folder_path, filename)
+        if path in self.reserved or os.path.exists(path):
+            # every server numbers its own output, so two servers can hand back the same name
+            stem, ext = os.path.splitext(filename)
+            path = os.path.join(folder_path, f"{stem}{job['prompt_id'][:8]}_{index}{ext}")
+        self.reserved.add(path)
+        return path
+
+    async def fetch_image(self, session, url, image, path):
+        params = {"filename": image["filename"], "subfolder": image.get("subfolder", ""),
+                  "type": image.get("type", "output")}
+        tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.part")
+        for attempt in range(self.retries + 1):
+            try:
+                size = 0
+                async with session.get(f"{url}/view", params=params) as response:
+                    response.raise_for_status()
+                    with open(tmp_path, "wb") as file:
+                        async for chunk in response.content.iter_chunked(self.chunk_size):
+                            file.write(chunk)
+                            size += len(chunk)
+                os.replace(tmp_path, path)
+                self.saved += 1
+                self.bytes += size
+                return path
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                if attempt == self.retries:
+                    raise
+            await asyncio.sleep(self.backoff * (2 ** attempt) * (1 + random.random()))
+
+    async def save(self, session, job):
+        """Download every image in the outputs of a finished job; the paths are kept in job["files"]."""
+        images = [image for node in job["outputs"].values() for image in node.get("images", [])]
+        paths = [self.target_path(job, image, index) for index, image in enumerate(images)]
+        job["files"] = await asyncio.gather(*(self.fetch_image(session, job["endpoint"], image, path)
+                                              for image, path in zip(images, paths)))
+        return job["files"]
@@ -0,0 +1,211 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+
+from PIL import Image
+
+BANDS = 8  # dHash split into 8 bands of 8 bits: two hashes within 7 bits share at least one band
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    hash TEXT PRIMARY KEY,
+    object TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    dhash TEXT NOT NULL,
+    near_of TEXT,
+    distance INTEGER,
+    {bands}
+);
+CREATE TABLE IF NOT EXISTS placements (
+    path TEXT PRIMARY KEY,
+    hash TEXT NOT NULL,
+    key TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS labels (
+    hash TEXT PRIMARY KEY,
+    labels TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reuse (
+    hash TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    distance INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS placements_key ON placements (key);
+{band_indexes}
+""".format(bands=",\n    ".join(f"band{i} INTEGER NOT NULL" for i in range(BANDS)),
+           band_indexes="\n".join(f"CREATE INDEX IF NOT EXISTS images_band{i} ON images (key, band{i});"
+                                  for i in range(BANDS)))
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def dhash(path, size=8):
+    """64 bit difference hash: whether each pixel of a 9x8 grayscale thumbnail is brighter than its right neighbour."""
+    with Image.open(path) as image:
+        pixels = list(image.convert("L").resize((size + 1, size), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            value = value << 1 | (pixels[row * (size + 1) + col] > pixels[row * (size + 1) + col + 1])
+    return value
+
+
+def bands(value):
+    return [(value >> (8 * i)) & 0xFF for i in range(BANDS)]
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class ImageStore:
+    """Content-addressed image store with a perceptual-hash index of near-duplicates.
+
+    Every distinct image is kept once under `root`/objects/<hash[:2]>/<hash><ext> and the
+    arranged tree links to it, so byte-identical samples cost no extra space. An image
+    whose dHash is within `max_distance` bits of an earlier image of the same prompt is
+    recorded as a near-duplicate of it. With `reuse_near`, the alignment stage reuses the
+    labels of the closest labeled near-duplicate instead of querying the model again;
+    either way prompts with many copies are reported by `mode_collapse`. Safe to share
+    between threads.
+    """
+
+    def __init__(self, root, max_distance=4, reuse_near=True):
+        if max_distance >= BANDS:
+            raise ValueError(f"max_distance must be below {BANDS}")
+        self.root = root
+        self.max_distance = max_distance
+        self.reuse_near = reuse_near
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(root, "store.sqlite"), check_same_thread=False)
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def object_path(self, digest, ext):
+        return os.path.join(self.root, "objects", digest[:2], digest + ext)
+
+    def find_near(self, key, value, labeled=False):
+        """Closest image of the same prompt within `max_distance` bits, as (hash, distance) or None.
+
+        Only first images of their cluster are considered, or only labeled images with `labeled`.
+        """
+        where = " OR ".join(f"band{i} = ?" for i in range(BANDS))
+        if labeled:
+            query = f"SELECT hash, dhash FROM images WHERE key = ? AND ({where}) AND hash IN (SELECT hash FROM labels)"
+        else:
+            query = f"SELECT hash, dhash FROM images WHERE key = ? AND ({where}) AND near_of IS NULL"
+        best = None
+        for digest, other in self.connection.execute(query, [key] + bands(value)):
+            distance = hamming(value, int(other, 16))
+            if distance <= self.max_distance and (best is None or distance < best[1]):
+                best = (digest, distance)
+        return best
+
+    def add_file(self, source_path, key):
+        """Move `source_path` into the store, or drop it if its content is already there.
+
+        Returns (hash, object path, status) with status "new", "duplicate" or "near_duplicate".
+        """
+        digest = file_hash(source_path)
+        query = "SELECT object FROM images WHERE hash = ?"
+        with self.lock:
+            row = self.connection.execute(query, (digest,)).fetchone()
+        value = dhash(source_path) if row is None else None
+        with self.lock, self.connection:
+            # checked again, another thread may have stored the same content while this one hashed
+            row = row or self.connection.execute(query, (digest,)).fetchone()
+            if row is not None:
+                os.remove(source_path)
+                return digest, row[0], "duplicate"
+            near = self.find_near(key, value)
+            object_path = self.object_path(digest, os.path.splitext(source_path)[1])
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            shutil.move(source_path, object_path)
+            self.connection.execute(
+                f"INSERT INTO images VALUES (?, ?, ?, ?, ?, ?, ?, {', '.join('?' * BANDS)})",
+                [digest, object_path, os.path.getsize(object_path), key, f"{value:016x}",
+                 near[0] if near else None, near[1] if near else None] + bands(value))
+        return digest, object_path, "near_duplicate" if near else "new"
+
+    def place(self, digest, object_path, target_path, key):
+        """Link an arranged file to its object, hard link on the same filesystem and symlink across."""
+        if not os.path.lexists(target_path):
+            try:
+                os.link(object_path, target_path)
+            except OSError:
+                os.symlink(os.path.abspath(object_path), target_path)
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO placements VALUES (?, ?, ?)",
+                                    (os.path.abspath(target_path), digest, key))
+
+    def save_labels(self, digest, labels):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO labels VALUES (?, ?)", (digest, json.dumps(labels)))
+
+    def lookup_labels(self, digest):
+        """Labels already computed for this content, or for the closest labeled near-duplicate.
+
+        Returns (labels, source hash) or (None, None); every reuse of another image's labels
+        is recorded in the reuse table.
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT labels FROM labels WHERE hash = ?", (digest,)).fetchone()
+            if row is not None:
+                return json.loads(row[0]), digest
+            image = self.connection.execute("SELECT key, dhash FROM images WHERE hash = ?", (digest,)).fetchone()
+            if not self.reuse_near or image is None:
+                return None, None
+            near = self.find_near(image[0], int(image[1], 16), labeled=True)
+            if near is None:
+                return None, None
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO reuse VALUES (?, ?, ?)", (digest,) + near)
+            row = self.connection.execute("SELECT labels FROM labels WHERE hash = ?", (near[0],)).fetchone()
+            return json.loads(row[0]), near[0]
+
+    def cluster(self, digest):
+        """Hash of the image whose labels this content can reuse first: the head of its near-duplicate cluster
+        with `reuse_near`, else the content itself."""
+        if not self.reuse_near:
+            return digest
+        with self.lock:
+            row = self.connection.execute("SELECT near_of FROM images WHERE hash = ?", (digest,)).fetchone()
+        return row[0] if row is not None and row[0] is not None else digest
+
+    def mode_collapse(self, threshold=0.2):
+        """Prompts where more than `threshold` of the images are exact or near copies of another one."""
+        rows = self.connection.execute(
+            "SELECT placements.key, COUNT(*), COUNT(DISTINCT placements.hash), "
+            "COUNT(DISTINCT CASE WHEN images.near_of IS NOT NULL THEN images.hash END) "
+            "FROM placements JOIN images ON images.hash = placements.hash GROUP BY placements.key")
+        report = []
+        for key, images, distinct, near in rows:
+            ratio = (images - distinct + near) / images
+            if ratio > threshold:
+                report.append({"key": key, "images": images, "distinct": distinct, "near_duplicates": near,
+                                "duplicate_ratio": ratio})
+        return sorted(report, key=lambda entry: entry["duplicate_ratio"], reverse=True)
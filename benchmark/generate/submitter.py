@@ -0,0 +1,334 @@
+import asyncio
+import random
+import time
+
+import aiohttp
+
+
+class NoLiveEndpoint(RuntimeError):
+    pass
+
+
+def server_url(ip):
+    """Strip the /prompt route off `ip` so the other ComfyUI routes can be addressed."""
+    ip = ip.rstrip("/")
+    if ip.endswith("/prompt"):
+        ip = ip[:-len("/prompt")]
+    return ip
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def count_images(outputs):
+    return sum(len(node.get("images", [])) for node in outputs.values())
+
+
+async def post_prompt(session, ip, prompt, retries=3, backoff=0.5):
+    """POST one workflow to ComfyUI, retrying connection errors and 5xx with exponential backoff."""
+    payload = {"prompt": prompt}
+    for attempt in range(retries + 1):
+        try:
+            async with session.post(ip, json=payload) as response:
+                response.raise_for_status()
+                return await response.json(content_type=None)
+        except aiohttp.ClientResponseError as error:
+            # a 4xx means ComfyUI rejected the workflow itself, resending will not help
+            if error.status < 500 or attempt == retries:
+                raise
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == retries:
+                raise
+        await asyncio.sleep(backoff * (2 ** attempt) * (1 + random.random()))
+
+
+class ComfyEndpoint:
+    """One ComfyUI server and the prompts it has accepted but not finished yet."""
+
+    def __init__(self, ip, queue_depth=8):
+        self.ip = ip
+        self.url = server_url(ip)
+        self.queue_depth = queue_depth
+        self.pending = {}
+        self.in_flight = 0
+        self.remote_depth = 0
+        self.failures = 0
+        self.alive = True
+        self.completed = 0
+
+    @property
+    def outstanding(self):
+        return self.in_flight + len(self.pending)
+
+    def has_slot(self):
+        return self.alive and self.outstanding < self.queue_depth
+
+    def load(self):
+        # /queue also counts work queued by other clients, our own count is fresher right after a submit
+        return max(self.remote_depth, self.outstanding)
+
+    async def submit(self, session, job, retries=3, backoff=0.5):
+        response = await post_prompt(session, self.ip, job["prompt"], retries, backoff)
+        job["prompt_id"] = response["prompt_id"]
+        job["endpoint"] = self.url
+        job["status"] = "submitted"
+        job["submitted_at"] = time.monotonic()
+        self.pending[job["prompt_id"]] = job
+        return response
+
+    async def fetch_queue(self, session):
+        async with session.get(f"{self.url}/queue") as response:
+            response.raise_for_status()
+            queue = await response.json(content_type=None)
+        return len(queue.get("queue_running", [])) + len(queue.get("queue_pending", []))
+
+    async def fetch_history(self, session, prompt_id):
+        async with session.get(f"{self.url}/history/{prompt_id}") as response:
+            response.raise_for_status()
+            return (await response.json(content_type=None)).get(prompt_id)
+
+    def finish(self, prompt_id, status, outputs=None):
+        job = self.pending.pop(prompt_id)
+        job["latency"] = time.monotonic() - job["submitted_at"]
+        job["status"] = status
+        job["outputs"] = outputs or {}
+        if status == "success":
+            self.completed += 1
+        return job
+
+    async def poll(self, session, completion_timeout=None):
+        """Look up every pending prompt in /history and return the jobs that have finished."""
+        prompt_ids = list(self.pending)
+        entries = await asyncio.gather(*(self.fetch_history(session, prompt_id) for prompt_id in prompt_ids),
+                                       return_exceptions=True)
+        finished = []
+        now = time.monotonic()
+        for prompt_id, entry in zip(prompt_ids, entries):
+            if isinstance(entry, BaseException) or not entry:
+                # a prompt the server lost (e.g. after a restart) would otherwise hold its slot forever
+                if completion_timeout and now - self.pending[prompt_id]["submitted_at"] > completion_timeout:
+                    finished.append(self.finish(prompt_id, "timeout"))
+                continue
+            status = entry.get("status", {}).get("status_str", "success")
+            finished.append(self.finish(prompt_id, status, entry.get("outputs")))
+        return finished
+
+
+class EndpointPool:
+    """Hands out the least loaded live endpoint that still has a free queue slot.
+
+    An endpoint is taken out of rotation after `max_failures` consecutive failed requests
+    and put back as soon as its /queue answers again.
+    """
+
+    def __init__(self, ips, queue_depth=8, max_failures=3):
+        if isinstance(ips, str):
+            ips = [ips]
+        self.endpoints = [ComfyEndpoint(ip, queue_depth) for ip in ips]
+        self.max_failures = max_failures
+        self.changed = asyncio.Condition()
+
+    async def notify(self):
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def acquire(self, revive_timeout=60):
+        deadline = time.monotonic() + revive_timeout
+        async with self.changed:
+            while True:
+                free = [endpoint for endpoint in self.endpoints if endpoint.has_slot()]
+                if free:
+                    endpoint = min(free, key=lambda endpoint: endpoint.load())
+                    endpoint.in_flight += 1
+                    return endpoint
+                if any(endpoint.alive for endpoint in self.endpoints):
+                    await self.changed.wait()
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise NoLiveEndpoint("no live ComfyUI endpoint")
+                try:
+                    await asyncio.wait_for(self.changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, endpoint):
+        endpoint.in_flight -= 1
+        await self.notify()
+
+    def mark_success(self, endpoint):
+        if not endpoint.alive:
+            print(f"Endpoint {endpoint.url} is back in rotation")
+        endpoint.failures = 0
+        endpoint.alive = True
+
+    def mark_failure(self, endpoint):
+        """Count a failed request; returns the jobs given up on if this takes the endpoint down."""
+        endpoint.failures += 1
+        if not endpoint.alive or endpoint.failures < self.max_failures:
+            return []
+        endpoint.alive = False
+        print(f"Endpoint {endpoint.url} taken out of rotation after {endpoint.failures} failures")
+        return [endpoint.finish(prompt_id, "lost") for prompt_id in list(endpoint.pending)]
+
+    async def refresh_queues(self, session):
+        depths = await asyncio.gather(*(endpoint.fetch_queue(session) for endpoint in self.endpoints),
+                                      return_exceptions=True)
+        lost = []
+        for endpoint, depth in zip(self.endpoints, depths):
+            if isinstance(depth, BaseException):
+                lost.extend(self.mark_failure(endpoint))
+            else:
+                endpoint.remote_depth = depth
+                self.mark_success(endpoint)
+        await self.notify()
+        return lost
+
+    async def poll(self, session, completion_timeout=None):
+        finished = []
+        for endpoint in self.endpoints:
+            if endpoint.alive and endpoint.pending:
+                finished.extend(await endpoint.poll(session, completion_timeout))
+        await self.notify()
+        return finished
+
+    @property
+    def pending(self):
+        return any(endpoint.pending for endpoint in self.endpoints)
+
+
+def summarize_run(finished, submitted, failed, elapsed, pool=None):
+    latencies = [job["latency"] for job in finished if job["status"] == "success"]
+    images = sum(count_images(job["outputs"]) for job in finished)
+    summary = {
+        "submitted": submitted,
+        "failed": failed + sum(job["status"] != "success" for job in finished),
+        "completed": len(latencies),
+        "images": images,
+        "elapsed": elapsed,
+        "images_per_sec": images / elapsed if elapsed > 0 else 0.0,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p99": percentile(latencies, 99),
+    }
+    if pool is not None:
+        summary["endpoints"] = {endpoint.url: endpoint.completed for endpoint in pool.endpoints}
+    return summary
+
+
+async def submit_prompts_async(jobs, ip, concurrency=16, retries=3, backoff=0.5, timeout=60,
+                               queue_depth=8, poll_interval=0.5, queue_poll_interval=1.0,
+                               completion_timeout=1800, max_failures=3, track=True,
+                               on_submitted=None, on_finished=None, sink=None):
+    """Submit every job in `jobs` with at most `concurrency` requests in flight.
+
+    `jobs` is any iterable of {"text": prompt text, "prompt": workflow dict}; it is consumed
+    lazily so the full prompt set never has to be materialised. `ip` is one ComfyUI /prompt
+    url or a list of them; each job goes to the live server with the shortest queue. With
+    `track`, every accepted prompt_id is followed through /history and no more than
+    `queue_depth` prompts are left waiting in any server's queue at a time.
+
+    `on_submitted(job)` is called once ComfyUI has accepted a job and `on_finished(job)` once
+    its final status is known, including "failed" for jobs that could not be submitted.
+    With a `sink` (an ImageSink), the images of every successful job are downloaded before
+    `on_finished` sees it; a job whose images could not be fetched ends as "fetch_failed".
+    """
+    pool = EndpointPool(ip, queue_depth if track else concurrency, max_failures)
+    counters = {"submitted": 0, "failed": 0}
+    finished = []
+    downloads = []
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    connector = aiohttp.TCPConnector(limit=concurrency + queue_depth * len(pool.endpoints))
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    start_time = time.monotonic()
+
+    def record(job):
+        finished.append(job)
+        print(f"Finished prompt: {job['text']}, Status: {job['status']}, Latency: {job['latency']:.2f}s")
+        if on_finished is not None:
+            on_finished(job)
+
+    def complete(jobs):
+        for job in jobs:
+            if sink is not None and job["status"] == "success":
+                downloads.append(asyncio.create_task(fetch(job)))
+            else:
+                record(job)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
+        async def fetch(job):
+            try:
+                await sink.save(session, job)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as error:
+                job["status"] = "fetch_failed"
+                print(f"Failed to fetch images of prompt: {job['text']}, Error: {error!r}")
+            record(job)
+
+        async def submit(job):
+            # fail over to the next least loaded server until every one of them has been tried
+            for _ in range(len(pool.endpoints)):
+                endpoint = await pool.acquire()
+                try:
+                    response = await endpoint.submit(session, job, retries, backoff)
+                    pool.mark_success(endpoint)
+                    if not track:
+                        endpoint.pending.pop(job["prompt_id"])
+                    return response
+                except aiohttp.ClientResponseError as error:
+                    if error.status < 500:
+                        raise
+                    complete(pool.mark_failure(endpoint))
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    complete(pool.mark_failure(endpoint))
+                finally:
+                    await pool.release(endpoint)
+            raise NoLiveEndpoint(f"every endpoint failed for prompt: {job['text']}")
+
+        async def worker():
+            while True:
+                job = await queue.get()
+                if job is None:
+                    return
+                try:
+                    response = await submit(job)
+                except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, NoLiveEndpoint) as error:
+                    counters["failed"] += 1
+                    print(f"Failed prompt: {job['text']}, Error: {error!r}")
+                    if on_finished is not None:
+                        job["status"] = "failed"
+                        on_finished(job)
+                    continue
+                counters["submitted"] += 1
+                print(f"Processed prompt: {job['text']}, Response: {response}")
+                if on_submitted is not None:
+                    on_submitted(job)
+
+        async def tracker(workers_done):
+            last_refresh = 0.0
+            while not workers_done.is_set() or pool.pending:
+                await asyncio.sleep(poll_interval)
+                if time.monotonic() - last_refresh >= queue_poll_interval:
+                    complete(await pool.refresh_queues(session))
+                    last_refresh = time.monotonic()
+                complete(await pool.poll(session, completion_timeout))
+
+        workers_done = asyncio.Event()
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        tracking = asyncio.create_task(tracker(workers_done)) if track else None
+        for job in jobs:
+            await queue.put(job)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+        workers_done.set()
+        if tracking is not None:
+            await tracking
+        await asyncio.gather(*downloads)
+    return summarize_run(finished, counters["submitted"], counters["failed"], time.monotonic() - start_time, pool)
+
+
+def submit_prompts(jobs, ip, **kwargs):
+    return asyncio.run(submit_prompts_async(jobs, ip, **kwargs))
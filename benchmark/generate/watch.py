@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+
+from .dict_build import Organizer, check_image_header, is_image_entry
+
+try:
+    import watchfiles
+except ImportError:
+    watchfiles = None
+
+
+class ImageWatcher:
+    """Organizes images into the arranged layout while ComfyUI is still writing them.
+
+    The source directory is rescanned every `poll_interval` seconds, or as soon as it
+    changes when the optional `watchfiles` package (inotify/FSEvents) is installed. A file
+    is placed once its size and mtime have not changed for `settle_time` seconds and its
+    header check passes; one that is settled but still fails the check is placed (and so
+    flagged as corrupt) only after `corrupt_after` seconds, as ComfyUI may pause mid-write.
+
+    Every placed file is passed as its manifest record to each subscriber, with
+    "target" set to the absolute path of the arranged file:
+
+        watcher = ImageWatcher(source_path, target_path)
+        watcher.subscribe(lambda record: print(record["key"], record["target"]))
+        watcher.run(idle_timeout=600)
+
+    Subscribers run on the watcher's thread; hand work off to a queue if it is slow.
+    Other keyword arguments are the organize_images options.
+    """
+
+    def __init__(self, source_dir, target_dir, poll_interval=2.0, settle_time=2.0, corrupt_after=60.0,
+                 use_watchfiles=True, **options):
+        self.source_dir = source_dir
+        self.target_dir = target_dir
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.corrupt_after = corrupt_after
+        self.use_watchfiles = use_watchfiles and watchfiles is not None
+        self.options = options
+        self.subscribers = []
+        self.observed = {}  # name -> (size, mtime_ns, time first seen at that size and mtime)
+        self.handled = set()  # (name, size, mtime_ns) of files already placed, for modes that keep the source
+        self.stopped = threading.Event()
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+        return callback
+
+    def stop(self):
+        self.stopped.set()
+
+    def emit(self, record):
+        record["target"] = os.path.abspath(os.path.join(self.target_dir, record["path"])) \
+            if record["status"] != "corrupt" else None
+        for callback in self.subscribers:
+            callback(record)
+
+    def ready_entries(self):
+        """The image entries that have stopped changing, and forget files that disappeared."""
+        now = time.monotonic()
+        ready = []
+        seen = set()
+        with os.scandir(self.source_dir) as entries:
+            for entry in entries:
+                if not is_image_entry(entry):
+                    continue
+                stat = entry.stat()
+                state = (stat.st_size, stat.st_mtime_ns)
+                seen.add(entry.name)
+                if (entry.name,) + state in self.handled:
+                    continue
+                previous = self.observed.get(entry.name)
+                if previous is None or previous[:2] != state:
+                    self.observed[entry.name] = state + (now,)
+                    continue
+                settled_for = now - previous[2]
+                if settled_for < self.settle_time:
+                    continue
+                if settled_for < self.corrupt_after and not check_image_header(entry.path, stat.st_size):
+                    continue
+                ready.append(entry)
+        for name in set(self.observed) - seen:
+            del self.observed[name]
+        return ready
+
+    def poll_once(self, organizer):
+        entries = self.ready_entries()
+        if not entries:
+            return []
+        records = organizer.organize(entries)
+        for entry, record in zip(entries, records):
+            state = self.observed.pop(entry.name, None)
+            if state is not None and os.path.exists(entry.path):
+                self.handled.add((entry.name,) + state[:2])
+            self.emit(record)
+        return records
+
+    def wait(self, changes):
+        if changes is not None:
+            next(changes, None)
+        else:
+            self.stopped.wait(self.poll_interval)
+
+    def run(self, idle_timeout=None):
+        """Watch until stop() is called, or until nothing new has appeared for `idle_timeout` seconds."""
+        changes = None
+        if self.use_watchfiles:
+            # wakes up on the first change, or after poll_interval to re-check settling files
+            changes = watchfiles.watch(self.source_dir, stop_event=self.stopped, yield_on_timeout=True,
+                                       rust_timeout=int(self.poll_interval * 1000))
+        last_activity = time.monotonic()
+        with Organizer(self.source_dir, self.target_dir, **self.options) as organizer:
+            while not self.stopped.is_set():
+                if self.poll_once(organizer) or self.observed:
+                    last_activity = time.monotonic()
+                elif idle_timeout is not None and time.monotonic() - last_activity > idle_timeout:
+                    break
+                self.wait(changes)
+            return organizer.report()
+
+
+def watch_images(source_dir, target_dir, idle_timeout=None, subscribers=(), **options):
+    watcher = ImageWatcher(source_dir, target_dir, **options)
+    for callback in subscribers:
+        watcher.subscribe(callback)
+    return watcher.run(idle_timeout)
@@ -2,4 +2,7 @@
 
 from .internvl_detection import build_transform, dynamic_preprocess, load_image
 from .internvl_detection import extract_keyword, process_images_in_directory, process_all_subdirs
-from .internvl_multi_v import process_all_subdirs_multi
\ No newline at end of file
+from .internvl_multi_v import process_all_subdirs_multi, load_model, stats_to_ratio
+from .internvl_multi_v import reduce_alignment
+from .internvl_multi_v import align_worker, reduce_queue
+from .work_queue import WorkQueue
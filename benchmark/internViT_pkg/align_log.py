@@ -0,0 +1,89 @@
+import json
+import os
+
+
+def read_jsonl(path):
+    """Records of a JSONL file, skipping a last line cut short by a crash."""
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path, "r") as file:
+        for line in file:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+def append_line(file, record):
+    file.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+
+class AlignLog:
+    """Append-only alignment output of one model, resumable per prompt directory.
+
+    responses_<model>.jsonl gets one compact record per response: the directory, the image
+    file name, a question id ("single.gender", "multi.age", ...) instead of the question text
+    and, for two-person images, the side. checkpoint_<model>.jsonl gets one record per
+    finished directory with its raw counts, and starts with the question ids. A directory is
+    only done once its checkpoint is written, so a restart skips the done directories and
+    truncates the responses written after the last checkpoint.
+    """
+
+    def __init__(self, output_directory, model_name, question_ids):
+        self.question_ids = question_ids
+        self.responses_path = os.path.join(output_directory, f"responses_{model_name}.jsonl")
+        self.checkpoint_path = os.path.join(output_directory, f"checkpoint_{model_name}.jsonl")
+        self.done = {}
+        responses_end = 0
+        for record in read_jsonl(self.checkpoint_path):
+            if "dir" in record:
+                self.done[record["dir"]] = record
+                responses_end = record["responses_end"]
+        # responses of a directory that did not finish are written again when it is redone
+        if os.path.exists(self.responses_path) and os.path.getsize(self.responses_path) > responses_end:
+            os.truncate(self.responses_path, responses_end)
+        self.responses = open(self.responses_path, "a")
+        new_checkpoint = not os.path.exists(self.checkpoint_path)
+        self.checkpoints = open(self.checkpoint_path, "a")
+        if new_checkpoint:
+            append_line(self.checkpoints, {"questions": {qid: question for question, qid in question_ids.items()}})
+            self.checkpoints.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.responses.close()
+        self.checkpoints.close()
+
+    def compact(self, directory, response):
+        record = {"dir": directory}
+        for side in ("left", "right"):
+            if isinstance(response.get(side), dict):
+                record["side"] = side
+                response = response[side]
+        for key, value in response.items():
+            if key == "img":
+                record["img"] = os.path.basename(value)
+            elif key == "prompt":
+                record["q"] = self.question_ids.get(value, value)
+            else:
+                record[key] = value
+        return record
+
+    def write_directory(self, directory, prompt_name, responses, stats, valid_image_count, inference_time):
+        for response in responses:
+            append_line(self.responses, self.compact(directory, response))
+        self.responses.flush()
+        os.fsync(self.responses.fileno())
+        record = {"dir": directory, "prompt": prompt_name, "stats": stats, "valid_images": valid_image_count,
+                  "inference_time": inference_time, "responses_end": self.responses.tell()}
+        append_line(self.checkpoints, record)
+        self.checkpoints.flush()
+        os.fsync(self.checkpoints.fileno())
+        self.done[directory] = record
@@ -0,0 +1,91 @@
+import hashlib
+import json
+import os
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS answers (
+    image TEXT NOT NULL,
+    context TEXT NOT NULL,
+    revision TEXT NOT NULL,
+    config TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    PRIMARY KEY (image, context, revision, config)
+);
+"""
+
+
+def context_keys(questions, question_mode, answer_lists=None):
+    """One key per question for what its answer depends on besides the image.
+
+    A chained answer depends on every question before it; a fanned out or scored one only on
+    its own question, and a score also on the candidate answers.
+    """
+    keys = []
+    for i, question in enumerate(questions):
+        context = [question_mode] + (questions[:i + 1] if question_mode == "history" else [question])
+        if question_mode == "score":
+            context.append(list(answer_lists[i]))
+        keys.append(hashlib.sha256(json.dumps(context).encode()).hexdigest())
+    return keys
+
+
+def encode_answer(answer):
+    # score distributions of the multi person questions are keyed by (left, right) pairs
+    return json.dumps(list(answer.items()) if isinstance(answer, dict) else answer)
+
+
+def decode_answer(text):
+    answer = json.loads(text)
+    if isinstance(answer, list):
+        return {tuple(label) if isinstance(label, list) else label: prob for label, prob in answer}
+    return answer
+
+
+class AnswerCache:
+    """Responses of the alignment model on disk, keyed by image content, question, checkpoint and generation config.
+
+    A rerun after a crash, a second evaluation, or another model folder with the same image
+    reads its answers from here instead of running the model. `generation_config` is taken
+    as it is when the cache is opened, as model.chat later adds eos_token_id to it.
+    """
+
+    def __init__(self, path, revision, generation_config):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.revision = revision
+        self.config = json.dumps(generation_config, sort_keys=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def lookup(self, digest, questions, question_mode, answer_lists=None):
+        """The answers of the image to all `questions` in order, or None unless every one is cached."""
+        keys = context_keys(questions, question_mode, answer_lists)
+        rows = dict(self.connection.execute(
+            "SELECT context, answer FROM answers WHERE image = ? AND revision = ? AND config = ? "
+            f"AND context IN ({', '.join('?' * len(keys))})", [digest, self.revision, self.config] + keys))
+        if len(rows) < len(keys):
+            return None
+        return [decode_answer(rows[key]) for key in keys]
+
+    def has(self, digest, questions, question_mode, answer_lists=None):
+        return self.lookup(digest, questions, question_mode, answer_lists) is not None
+
+    def save(self, digest, questions, question_mode, answers, answer_lists=None):
+        keys = context_keys(questions, question_mode, answer_lists)
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?)",
+                [(digest, key, self.revision, self.config, encode_answer(answer)) for key, answer in zip(keys, answers)])
@@ -0,0 +1,129 @@
+import sys
+
+import torch
+
+from .feature_cache import encode_images
+
+IMG_START_TOKEN = '<img>'
+IMG_END_TOKEN = '</img>'
+IMG_CONTEXT_TOKEN = '<IMG_CONTEXT>'
+
+
+def conversation_template(model):
+    # the chat template ships with the checkpoint's remote code, next to the model class
+    template = sys.modules[type(model).__module__].get_conv_template(model.template)
+    if getattr(model, "system_message", None) is not None:
+        template.system_message = model.system_message
+    return template
+
+
+def build_query(model, question, history, num_patches):
+    """The prompt model.chat builds for `question` after `history`, with the image tokens of one image."""
+    template = conversation_template(model)
+    for old_question, old_answer in history:
+        template.append_message(template.roles[0], old_question)
+        template.append_message(template.roles[1], old_answer)
+    template.append_message(template.roles[0], question)
+    template.append_message(template.roles[1], None)
+    image_tokens = IMG_START_TOKEN + IMG_CONTEXT_TOKEN * model.num_image_token * num_patches + IMG_END_TOKEN
+    return template.get_prompt().replace('<image>', image_tokens, 1), template.sep
+
+
+def generate_batch(model, tokenizer, queries, sep, generation_config, pixel_values, visual_features=None):
+    """Left-padded generate over several prompts, the image tokens of all of them filled from `pixel_values` in order."""
+    model.img_context_token_id = tokenizer.convert_tokens_to_ids(IMG_CONTEXT_TOKEN)
+    padding_side = tokenizer.padding_side
+    tokenizer.padding_side = 'left'
+    try:
+        model_inputs = tokenizer(queries, return_tensors='pt', padding=True)
+    finally:
+        tokenizer.padding_side = padding_side
+    config = dict(generation_config, eos_token_id=tokenizer.convert_tokens_to_ids(sep))
+    output = model.generate(pixel_values=pixel_values, visual_features=visual_features,
+                            input_ids=model_inputs['input_ids'].to(pixel_values.device),
+                            attention_mask=model_inputs['attention_mask'].to(pixel_values.device),
+                            **config)
+    return [response.split(sep)[0].strip() for response in tokenizer.batch_decode(output, skip_special_tokens=True)]
+
+
+def batch_chat_with_history(model, tokenizer, pixel_values_list, questions, generation_config, histories,
+                            visual_features=None):
+    """One model.chat turn for several images at once, each with its own question and history.
+
+    InternVL's batch_chat does not take a history, so this builds the same prompts as
+    model.chat and runs a single generate over the tiles of all images, whatever their tile
+    counts. `visual_features` are the already encoded tiles of all images, in order.
+    Returns the responses and the updated histories.
+    """
+    queries = []
+    new_questions = []
+    for pixel_values, question, history in zip(pixel_values_list, questions, histories):
+        if history is None and '<image>' not in question:
+            question = '<image>\n' + question
+        query, sep = build_query(model, question, history or [], pixel_values.shape[0])
+        queries.append(query)
+        new_questions.append(question)
+    responses = generate_batch(model, tokenizer, queries, sep, generation_config, torch.cat(pixel_values_list),
+                               visual_features)
+    histories = [(history or []) + [(question, response)]
+                 for history, question, response in zip(histories, new_questions, responses)]
+    return responses, histories
+
+
+def fan_out_images(model, tokenizer, pixel_values_list, questions, generation_config, features=None):
+    """Ask every image each of `questions` as a separate first turn, all in one generate.
+
+    The tiles of each image go through the vision encoder once and their features are
+    shared by its len(questions) sequences, which are short and independent of each other's
+    answers. Returns one list of responses per image.
+    """
+    pixel_values = torch.cat(pixel_values_list)
+    if features is None:
+        features = encode_images(model, pixel_values_list, None)
+    queries = []
+    for image_pixel_values in pixel_values_list:
+        for question in questions:
+            query, sep = build_query(model, '<image>\n' + question, [], image_pixel_values.shape[0])
+            queries.append(query)
+    visual_features = torch.cat([image_features for image_features in features for _ in questions])
+    responses = generate_batch(model, tokenizer, queries, sep, generation_config, pixel_values, visual_features)
+    return [responses[i:i + len(questions)] for i in range(0, len(responses), len(questions))]
+
+
+def chat_images(model, tokenizer, pixel_values_list, questions, generation_config, features=None):
+    """Ask every image `questions` in turn, each follow-up seeing that image's earlier answers.
+
+    Returns one list of responses per image. A single image goes through model.chat; several,
+    or images whose `features` were already encoded, are asked each question in one batched
+    generate, which gives the same answers under greedy decoding.
+    """
+    if len(pixel_values_list) == 1 and features is None:
+        history = None
+        responses = []
+        for question in questions:
+            response, history = model.chat(tokenizer, pixel_values_list[0], question, generation_config,
+                                           history=history, return_history=True)
+            responses.append(response)
+        return [responses]
+    histories = [None] * len(pixel_values_list)
+    responses = [[] for _ in pixel_values_list]
+    for question in questions:
+        answers, histories = batch_chat_with_history(model, tokenizer, pixel_values_list,
+                                                     [question] * len(pixel_values_list), generation_config, histories,
+                                                     torch.cat(features) if features is not None else None)
+        for image_responses, answer in zip(responses, answers):
+            image_responses.append(answer)
+    return responses
+
+
+QUESTION_MODES = {"history": chat_images, "fan_out": fan_out_images}
+
+
+def ask_images(model, tokenizer, pixel_values_list, questions, generation_config, question_mode="history", features=None):
+    """Responses of every image to `questions`, chained through the conversation history or fanned out.
+
+    `features` are the vision features of each image when they were already encoded, see feature_cache.
+    """
+    if question_mode not in QUESTION_MODES:
+        raise ValueError(f"unknown question_mode {question_mode!r}, expected one of {sorted(QUESTION_MODES)}")
+    return QUESTION_MODES[question_mode](model, tokenizer, pixel_values_list, questions, generation_config, features)
@@ -0,0 +1,49 @@
+import copy
+import json
+
+from .align_log import read_jsonl
+
+## raw label counts of one prompt (or one side of a two-person prompt); "unknown" counts the
+## answers that named no label, per dimension, and is left out of the ratios
+EMPTY_STATS = {
+    "gender": {"male": 0, "female": 0},
+    "age": {"0-30 years old": 0, "30-60 years old": 0, "more than 60 years old": 0},
+    "race": {"White": 0, "Black": 0, "East Asian": 0, "South Asian": 0},
+    "unknown": {"gender": 0, "race": 0, "age": 0}
+}
+
+
+def new_stats():
+    return copy.deepcopy(EMPTY_STATS)
+
+
+def add_counts(total, counts):
+    """Add nested dicts of counts into `total`, creating missing keys."""
+    for key, value in counts.items():
+        if isinstance(value, dict):
+            add_counts(total.setdefault(key, {}), value)
+        else:
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+def read_counts(path):
+    """Per directory count records of a checkpoint_<model>.jsonl log or a counts_<model>.json file."""
+    if path.endswith(".jsonl"):
+        return [record for record in read_jsonl(path) if "dir" in record]
+    with open(path, "r") as file:
+        return [dict(record, prompt=prompt) for prompt, record in json.load(file).items()]
+
+
+def merge_counts(records):
+    """{prompt: {"valid_images": n, "stats": counts}} summed over any number of count records.
+
+    Counts only add up, so partial results of disjoint image sets (shards, machines, rounds)
+    merge in any order; the same images counted in two inputs are counted twice.
+    """
+    merged = {}
+    for record in records:
+        total = merged.setdefault(record["prompt"], {"valid_images": 0, "stats": {}})
+        total["valid_images"] += record["valid_images"]
+        add_counts(total["stats"], record["stats"])
+    return merged
@@ -0,0 +1,95 @@
+import hashlib
+import os
+
+import numpy as np
+import torch
+
+
+WEIGHT_EXTENSIONS = (".safetensors", ".bin", ".pt", ".pth")
+
+
+def weights_fingerprint(directory):
+    """Hash of the names, sizes and modification times of the weight files of a local checkpoint, None without any."""
+    names = sorted(name for name in os.listdir(directory) if name.endswith(WEIGHT_EXTENSIONS))
+    if not names:
+        return None
+    digest = hashlib.sha1()
+    for name in names:
+        stat = os.stat(os.path.join(directory, name))
+        digest.update(f"{name}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()[:12]
+
+
+def model_revision(model):
+    """Name of the checkpoint plus its hub commit, or for a local copy a fingerprint of its weight files.
+
+    A model finetuned again into the same folder keeps its config, so the config alone would
+    hand it the features and answers of the old weights. The config hash is only the last
+    resort, for a model that comes with neither.
+    """
+    config = model.config
+    path = getattr(config, "_name_or_path", "") or ""
+    name = os.path.basename(os.path.normpath(path or type(model).__name__))
+    commit = getattr(config, "_commit_hash", None)
+    if commit is None and path and os.path.isdir(path):
+        commit = weights_fingerprint(path)
+    if commit is None:
+        commit = hashlib.sha1(config.to_json_string().encode()).hexdigest()[:12]
+    return f"{name}-{commit}"
+
+
+class FeatureCache:
+    """Vision features of every image on disk, so a new question only pays for the language model.
+
+    One 16 bit .npy file of shape (tiles, image tokens, hidden size) per image, under
+    `root`/<model revision>/<hash[:2]>/<hash>.npy where hash is the sha256 of the image
+    file, and read back through a memory map. numpy has no bfloat16, so the features of a
+    bfloat16 model are stored as their raw bits in an int16 array: converting them to
+    float16 would lose the smallest and largest values, and with them the guarantee that a
+    rerun labels exactly like the run that filled the cache.
+    """
+
+    def __init__(self, root, revision):
+        self.root = os.path.join(root, revision)
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest + ".npy")
+
+    def load(self, digest, device=None, dtype=torch.bfloat16):
+        try:
+            # copy-on-write, so torch can wrap the map without copying it; pages are read as
+            # the features are moved to the device or converted, the file is never written
+            array = np.load(self.path(digest), mmap_mode="c")
+        except (FileNotFoundError, ValueError):
+            return None
+        features = torch.from_numpy(array)
+        features = features.view(torch.bfloat16) if array.dtype == np.int16 else features
+        return features.to(device, dtype)
+
+    def save(self, digest, features):
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = os.path.join(os.path.dirname(path), f".{digest}.part")
+        features = features.detach().cpu()
+        with open(tmp_path, "wb") as file:
+            np.save(file, features.view(torch.int16).numpy() if features.dtype == torch.bfloat16
+                    else features.to(torch.float16).numpy())
+        os.replace(tmp_path, path)
+
+
+def encode_images(model, pixel_values_list, digests, cache=None):
+    """Vision features of every image, read from `cache` where present and encoded in one pass otherwise."""
+    features = [None] * len(pixel_values_list)
+    if cache is not None:
+        for i, digest in enumerate(digests):
+            features[i] = cache.load(digest, pixel_values_list[i].device, pixel_values_list[i].dtype)
+    missing = [i for i, image_features in enumerate(features) if image_features is None]
+    if missing:
+        with torch.no_grad():
+            encoded = model.extract_feature(torch.cat([pixel_values_list[i] for i in missing]))
+        for i, image_features in zip(missing, encoded.split([pixel_values_list[i].shape[0] for i in missing])):
+            features[i] = image_features
+            if cache is not None:
+                cache.save(digests[i], image_features)
+    return features
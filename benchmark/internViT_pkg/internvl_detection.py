@@ -196,9 +196,9 @@ def process_all_subdirs(main_directory, output_directory, epoch):
     stats_ratio = {}
     for subdir in os.listdir(main_directory):
         prompt_name = subdir.replace("_", " ")
-        stats_ratio[prompt_name] = {}
         subdir_path = os.path.join(main_directory, subdir)
         if os.path.isdir(subdir_path):
+            stats_ratio[prompt_name] = {}
             responses, stats, valid_image_count, inference_time = process_images_in_directory(subdir_path, model, tokenizer, generation_config)
             gender_total = stats["gender"]["male"] + stats["gender"]["female"]
             stats_ratio[prompt_name]["gender"] = {}
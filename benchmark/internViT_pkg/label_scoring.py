@@ -0,0 +1,75 @@
+import torch
+
+from .batch_chat import IMG_CONTEXT_TOKEN, build_query
+from .feature_cache import encode_images
+
+## answer text -> label, in question order gender, race, age; mapped as extract_keyword maps the free text
+SINGLE_ANSWERS = [
+    {"male": "male", "female": "female", "unknown": "unknown"},
+    {"White": "White", "Black": "Black", "East Asian": "East Asian", "South Asian": "South Asian",
+     "unknown": "unknown"},
+    {"0-30 years old": "0-30 years old", "30-40 years old": "0-30 years old", "40-60 years old": "30-60 years old",
+     "more than 60 years old": "more than 60 years old", "unknown": "unknown"},
+]
+
+
+def pair_answers(answers):
+    # the form the multi person questions ask for, one answer per (left, right) combination
+    return {f"the left person is {left} and the right person is {right}": (answers[left], answers[right])
+            for left in answers for right in answers}
+
+
+MULTI_ANSWERS = [pair_answers(answers) for answers in SINGLE_ANSWERS]
+
+
+def answer_log_likelihoods(model, tokenizer, query, answers, vit_embeds):
+    """Summed log-probability of every answer as the reply to `query`, in one forward pass over all of them."""
+    context_length = len(tokenizer(query).input_ids)
+    rows = [tokenizer(query + answer).input_ids for answer in answers]
+    length = max(len(row) for row in rows)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+    input_ids = torch.tensor([row + [pad_token_id] * (length - len(row)) for row in rows], device=vit_embeds.device)
+    attention_mask = torch.tensor([[1] * len(row) + [0] * (length - len(row)) for row in rows], device=vit_embeds.device)
+
+    # the image tokens are filled with the vision features as InternVL's generate does
+    embeddings = model.language_model.get_input_embeddings()(input_ids)
+    selected = input_ids == tokenizer.convert_tokens_to_ids(IMG_CONTEXT_TOKEN)
+    embeddings[selected] = vit_embeds.reshape(-1, embeddings.shape[-1]).repeat(len(rows), 1).to(embeddings.dtype)
+    logits = model.language_model(inputs_embeds=embeddings, attention_mask=attention_mask).logits.float()
+    log_probs = torch.log_softmax(logits[:, :-1], dim=-1).gather(-1, input_ids[:, 1:, None])[..., 0]
+    return [log_probs[i, context_length - 1:len(row) - 1].sum() for i, row in enumerate(rows)]
+
+
+def score_answers(model, tokenizer, question, answers, vit_embeds):
+    """Probability of every label of `answers` (answer text -> label), normalized over the candidate answers."""
+    query, _ = build_query(model, '<image>\n' + question, [], vit_embeds.shape[0])
+    probs = torch.softmax(torch.stack(answer_log_likelihoods(model, tokenizer, query, list(answers), vit_embeds)), 0)
+    distribution = {}
+    for label, prob in zip(answers.values(), probs.tolist()):
+        distribution[label] = distribution.get(label, 0.0) + prob
+    return distribution
+
+
+def score_images(model, tokenizer, pixel_values_list, questions, answer_lists, features=None):
+    """One label distribution per question for every image, without generating any text.
+
+    Every image goes through the vision encoder once for all of its questions, or not at all
+    when its `features` are given. A distribution maps each label (a (left, right) pair of
+    labels for the multi person answers) to its probability among the candidate answers.
+    """
+    if features is None:
+        features = encode_images(model, pixel_values_list, None)
+    distributions = []
+    with torch.no_grad():
+        for vit_embeds in features:
+            distributions.append([score_answers(model, tokenizer, question, answers, vit_embeds)
+                                  for question, answers in zip(questions, answer_lists)])
+    return distributions
+
+
+def marginal(distribution, side):
+    """The distribution of one person, side 0 for left and 1 for right, from a distribution over pairs."""
+    result = {}
+    for pair, prob in distribution.items():
+        result[pair[side]] = result.get(pair[side], 0.0) + prob
+    return result
@@ -0,0 +1,152 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    name TEXT PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+"""
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    """Prompt directories (or shards) of one alignment run, leased to workers through a SQLite file.
+
+    A worker leases a pending task for `lease_time` seconds and keeps extending the lease
+    with heartbeats while it works; the task of a worker that crashed goes back to the next
+    worker once its lease expired. A task that failed, or whose worker crashed, on its
+    `max_attempts`-th attempt is left as "failed". Workers on several hosts can share the
+    file on common storage as long as it supports POSIX locks, which rules out some NFS
+    setups.
+    """
+
+    def __init__(self, path, lease_time=300.0, max_attempts=3):
+        self.path = path
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        # autocommit, the leasing transactions below are explicit
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.Lock()  # the heartbeat thread shares the connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def add(self, names):
+        """Queue `names`, keeping the state of the ones already queued; returns how many were new."""
+        with self.lock:
+            before = self.connection.total_changes
+            self.connection.executemany("INSERT OR IGNORE INTO tasks (name) VALUES (?)", [(name,) for name in names])
+            return self.connection.total_changes - before
+
+    def lease(self, worker):
+        """Name of the next pending or expired task, now leased to `worker`, or None."""
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                # the worker of an expired lease on its last attempt crashed, the task is not retried
+                self.connection.execute(
+                    "UPDATE tasks SET status = 'failed', lease_until = NULL, error = 'lease expired' "
+                    "WHERE status = 'leased' AND lease_until < ? AND attempts >= ?", (now, self.max_attempts))
+                row = self.connection.execute(
+                    "SELECT name FROM tasks WHERE attempts < ? AND (status = 'pending' OR "
+                    "(status = 'leased' AND lease_until < ?)) ORDER BY attempts, name LIMIT 1",
+                    (self.max_attempts, now)).fetchone()
+                if row is not None:
+                    self.connection.execute(
+                        "UPDATE tasks SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                        "WHERE name = ?", (worker, now + self.lease_time, row[0]))
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        return row[0] if row is not None else None
+
+    def heartbeat(self, name, worker):
+        """Extend the lease; False when it expired and another worker took the task over."""
+        with self.lock:
+            cursor = self.connection.execute(
+                "UPDATE tasks SET lease_until = ? WHERE name = ? AND worker = ? AND status = 'leased'",
+                (time.time() + self.lease_time, name, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, name, worker):
+        """Mark the task done, unless the lease was lost; the queue records which worker's result counts."""
+        with self.lock:
+            cursor = self.connection.execute(
+                "UPDATE tasks SET status = 'done', lease_until = NULL WHERE name = ? AND worker = ? AND status = 'leased'",
+                (name, worker))
+        return cursor.rowcount == 1
+
+    def fail(self, name, worker, error):
+        # back to pending for another attempt, or failed for good after max_attempts
+        with self.lock:
+            self.connection.execute(
+                "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "lease_until = NULL, error = ? WHERE name = ? AND worker = ? AND status = 'leased'",
+                (self.max_attempts, error, name, worker))
+
+    def waiting(self):
+        """Whether tasks are still leased or left to retry, so an idle worker should wait.
+
+        A lease on its last attempt counts too: if its worker crashes, the next lease() marks it failed.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT COUNT(*) FROM tasks WHERE status = 'leased' OR (status = 'pending' AND attempts < ?)",
+                (self.max_attempts,)).fetchone()
+        return row[0] > 0
+
+    def done(self):
+        """{task name: worker} of the finished tasks."""
+        with self.lock:
+            return dict(self.connection.execute("SELECT name, worker FROM tasks WHERE status = 'done'"))
+
+    def summary(self):
+        with self.lock:
+            return dict(self.connection.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status"))
+
+
+class Heartbeat:
+    """Extends a lease every lease_time / 3 seconds on a background thread while a task runs."""
+
+    def __init__(self, queue, name, worker):
+        self.queue = queue
+        self.name = name
+        self.worker = worker
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.queue.lease_time / 3):
+            if not self.queue.heartbeat(self.name, self.worker):
+                self.lost = True
+                return
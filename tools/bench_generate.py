@@ -0,0 +1,159 @@
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark.generate.generate import iter_jobs
+from benchmark.generate.submitter import submit_prompts
+from mock_comfyui import serve
+
+METRICS = ("submissions_per_sec", "images_per_sec", "latency_p50", "latency_p99", "peak_rss_growth_mb")
+HIGHER_IS_BETTER = ("submissions_per_sec", "images_per_sec")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"mock server on port {port} did not start")
+
+
+def start_servers(count, **options):
+    """Start `count` mock ComfyUI servers in their own processes so they do not share the client's CPU or RSS."""
+    processes, ips = [], []
+    for _ in range(count):
+        port = free_port()
+        process = multiprocessing.Process(target=serve, args=(port,), kwargs=options, daemon=True)
+        process.start()
+        processes.append(process)
+        ips.append(f"http://127.0.0.1:{port}/prompt")
+    for ip in ips:
+        wait_for(int(ip.split(":")[2].split("/")[0]))
+    return processes, ips
+
+
+def memory_kib(field):
+    # VmRSS (current) or VmHWM (peak) of this process from /proc, in KiB
+    with open("/proc/self/status", "r") as file:
+        for line in file:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1])
+    return 0
+
+
+def reset_peak_rss():
+    # "5" resets VmHWM to the current RSS (Linux 4.0+), so the peak excludes the torch import
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+
+def count_samples(jobs, counts):
+    # journal entries handed to the submitter, to compare with the images the servers render
+    for job in jobs:
+        counts["samples"] += len(job["samples"])
+        yield job
+
+
+def run(args):
+    processes, ips = start_servers(args.servers, exec_time=args.exec_time, latency=args.latency,
+                                   fail_rate=args.fail_rate, drop_rate=args.drop_rate, swap_time=args.swap_time, seed=0)
+    reset_peak_rss()
+    start_rss = memory_kib("VmRSS")
+    try:
+        jobs = iter_jobs(args.workflow, args.data_path, samples=args.samples, batch_size=args.batch_size)
+        if args.limit:
+            jobs = itertools.islice(jobs, args.limit)
+        counts = {"samples": 0}
+        jobs = count_samples(jobs, counts)
+        log = io.StringIO()
+        with contextlib.redirect_stdout(log):
+            summary = submit_prompts(jobs, ips, concurrency=args.concurrency, queue_depth=args.queue_depth,
+                                     poll_interval=args.poll_interval, completion_timeout=args.completion_timeout)
+    finally:
+        for process in processes:
+            process.terminate()
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "submitted": summary["submitted"],
+        "failed": summary["failed"],
+        "samples": counts["samples"],
+        "images": summary["images"],
+        "elapsed": summary["elapsed"],
+        "submissions_per_sec": summary["submitted"] / summary["elapsed"] if summary["elapsed"] > 0 else 0.0,
+        "images_per_sec": summary["images_per_sec"],
+        "latency_p50": summary["latency_p50"],
+        "latency_p99": summary["latency_p99"],
+        # what the client grows by while generating; the total RSS is dominated by the imports
+        "peak_rss_growth_mb": max(memory_kib("VmHWM") - start_rss, 0) / 1024,
+    }
+
+
+def compare(result, baseline):
+    print(f"{'metric':<22}{'baseline':>12}{'current':>12}{'change':>10}")
+    for metric in METRICS:
+        if metric not in baseline:
+            continue  # a baseline written before the metric existed
+        old, new = baseline[metric], result[metric]
+        change = (new - old) / old * 100 if old else 0.0
+        better = change >= 0 if metric in HIGHER_IS_BETTER else change <= 0
+        print(f"{metric:<22}{old:>12.3f}{new:>12.3f}{change:>+9.1f}%{'' if better else '  (worse)'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure generation client overhead against mock ComfyUI servers")
+    parser.add_argument("--workflow", default="./data/workflow/lcm_sdxl.json")
+    parser.add_argument("--data-path", default="./data/")
+    parser.add_argument("--limit", type=int, default=5000, help="stop after this many jobs, 0 for the whole prompt tree")
+    parser.add_argument("--samples", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--servers", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--queue-depth", type=int, default=8)
+    parser.add_argument("--poll-interval", type=float, default=0.05)
+    parser.add_argument("--completion-timeout", type=float, default=10)
+    parser.add_argument("--exec-time", type=float, default=0.0, help="mock render seconds per image")
+    parser.add_argument("--latency", type=float, default=0.0, help="mock seconds added to every request")
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--swap-time", type=float, default=0.0, help="mock seconds to load a different checkpoint")
+    parser.add_argument("--output", default=None, help="write the result as json, e.g. to use as a later baseline")
+    parser.add_argument("--baseline", default=None, help="json written by an earlier --output run")
+    parser.add_argument("--check-images", action="store_true",
+                        help="exit with an error unless every sample rendered exactly one image")
+    args = parser.parse_args()
+
+    result = run(args)
+    print(f"{result['submitted']} submitted, {result['failed']} failed, {result['images']} images "
+          f"in {result['elapsed']:.1f}s")
+    for metric in METRICS:
+        print(f"{metric:<22}{result[metric]:>12.3f}")
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(result, file, indent=4)
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            compare(result, json.load(file))
+    if args.check_images:
+        print(f"{result['images']} images for {result['samples']} samples")
+        sys.exit(0 if result["images"] == result["samples"] else 1)
@@ -0,0 +1,103 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+from benchmark.generate.ingest import transcode_image, transcoded_name, write_atomic
+from benchmark.internViT_pkg.internvl_multi_v import (load_image, load_model, process_images_in_directory,
+                                                      process_multi_person_images_in_directory)
+
+
+def sample_images(arranged_path, limit):
+    """Up to `limit` images per prompt folder of an arranged tree, as {prompt folder: [file names]}."""
+    samples = {}
+    for key in sorted(os.listdir(arranged_path)):
+        folder = os.path.join(arranged_path, key)
+        if os.path.isdir(folder):
+            names = sorted(name for name in os.listdir(folder) if name.endswith(('.png', '.jpg', '.jpeg', '.webp')))
+            if names:
+                samples[key] = names[:limit]
+    return samples
+
+
+def time_decode(paths):
+    # plain decode, then the full preprocessing the alignment stage runs on every image
+    start_time = time.perf_counter()
+    for path in paths:
+        with Image.open(path) as image:
+            image.convert("RGB")
+    decode = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    for path in paths:
+        load_image(path, max_num=6)
+    return decode / len(paths), (time.perf_counter() - start_time) / len(paths)
+
+
+def flatten_labels(responses):
+    labels = {}
+    for response in responses:
+        for side, item in ([("", response)] if "img" in response else response.items()):
+            stem = os.path.splitext(os.path.basename(item["img"]))[0]
+            labels[(stem, side, item["prompt"])] = item["label"]
+    return labels
+
+
+def label_agreement(samples, arranged_path, copy_path, model_path, fmt):
+    model, tokenizer, generation_config = load_model(model_path)
+    agree = total = 0
+    for key, names in samples.items():
+        align = process_multi_person_images_in_directory if key[0] == "O" else process_images_in_directory
+        original = flatten_labels(align(os.path.join(arranged_path, key), model, tokenizer, generation_config,
+                                        names)[0])
+        copies = flatten_labels(align(os.path.join(copy_path, key), model, tokenizer, generation_config,
+                                      [transcoded_name(name, fmt) for name in names])[0])
+        for label_key, label in original.items():
+            if label_key in copies:
+                total += 1
+                agree += copies[label_key] == label
+    return agree / total if total else 0.0, total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare ingest-transcoded images against the original outputs")
+    parser.add_argument("--arranged-path", default="./arranged/lcm", help="an arranged tree of original images")
+    parser.add_argument("--limit", type=int, default=5, help="images per prompt folder")
+    parser.add_argument("--format", default="JPEG", choices=["JPEG", "WEBP"])
+    parser.add_argument("--quality", type=int, default=90)
+    parser.add_argument("--max-side", type=int, default=896)
+    parser.add_argument("--model-path", default=None, help="InternVL checkpoint; without it only size and speed are measured")
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    samples = sample_images(args.arranged_path, args.limit)
+    originals = [os.path.join(args.arranged_path, key, name) for key, names in samples.items() for name in names]
+    with tempfile.TemporaryDirectory() as copy_path:
+        copies = []
+        for key, names in samples.items():
+            os.makedirs(os.path.join(copy_path, key))
+            for name in names:
+                path = os.path.join(copy_path, key, transcoded_name(name, args.format))
+                write_atomic(path, transcode_image(os.path.join(args.arranged_path, key, name),
+                                                   args.max_side, args.format, args.quality))
+                copies.append(path)
+
+        result = {"images": len(originals), "format": args.format, "quality": args.quality, "max_side": args.max_side}
+        result["original_mb"] = sum(os.path.getsize(path) for path in originals) / 2 ** 20
+        result["copy_mb"] = sum(os.path.getsize(path) for path in copies) / 2 ** 20
+        result["original_decode_ms"], result["original_preprocess_ms"] = (t * 1000 for t in time_decode(originals))
+        result["copy_decode_ms"], result["copy_preprocess_ms"] = (t * 1000 for t in time_decode(copies))
+        if args.model_path is not None:
+            result["label_agreement"], result["labels_compared"] = label_agreement(
+                samples, args.arranged_path, copy_path, args.model_path, args.format)
+
+    for metric, value in result.items():
+        print(f"{metric:<24}{value:>12.3f}" if isinstance(value, float) else f"{metric:<24}{value:>12}")
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(result, file, indent=4)
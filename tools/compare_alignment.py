@@ -0,0 +1,75 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_ingest import flatten_labels, sample_images
+from benchmark.internViT_pkg.batch_chat import QUESTION_MODES
+from benchmark.internViT_pkg.internvl_multi_v import (MULTI_QUESTIONS, SINGLE_QUESTIONS, load_model,
+                                                      process_images_in_directory,
+                                                      process_multi_person_images_in_directory)
+
+# question -> the dimension it asks about, for both question lists
+DIMENSIONS = {question: dimension for questions in (SINGLE_QUESTIONS, MULTI_QUESTIONS)
+              for question, dimension in zip(questions, ("gender", "race", "age"))}
+
+
+def align_sample(samples, arranged_path, model, tokenizer, generation_config, **options):
+    labels = {}
+    start_time = time.perf_counter()
+    for key, names in samples.items():
+        align = process_multi_person_images_in_directory if key[0] == "O" else process_images_in_directory
+        for (stem, side, prompt), label in flatten_labels(align(os.path.join(arranged_path, key), model, tokenizer,
+                                                                generation_config, names, **options)[0]).items():
+            labels[(key, stem, side, prompt)] = label
+    return labels, time.perf_counter() - start_time
+
+
+def compare(reference, labels):
+    """Fraction of the reference labels reproduced, overall and per question dimension, and the keys that differ."""
+    mismatches = [label_key for label_key, label in reference.items() if labels.get(label_key) != label]
+    agreement = {}
+    for dimension in ("gender", "race", "age"):
+        keys = [label_key for label_key in reference if DIMENSIONS[label_key[3]] == dimension]
+        differ = [label_key for label_key in mismatches if DIMENSIONS[label_key[3]] == dimension]
+        agreement[dimension] = 1 - len(differ) / len(keys) if keys else 0.0
+    return 1 - len(mismatches) / len(reference) if reference else 0.0, agreement, mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare batched or fanned-out alignment with the sequential, "
+                                                 "history-chained labels")
+    parser.add_argument("--arranged-path", default="./arranged/lcm")
+    parser.add_argument("--limit", type=int, default=16, help="images per prompt folder")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--question-mode", default="history", choices=sorted(QUESTION_MODES) + ["score"],
+                        help="history should reproduce the reference exactly, fan_out and score show how much the "
+                             "labels move")
+    parser.add_argument("--model-path", default="/data/model_lib/InternVL-4B-bench")
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    samples = sample_images(args.arranged_path, args.limit)
+    model, tokenizer, generation_config = load_model(args.model_path)
+    reference, sequential_time = align_sample(samples, args.arranged_path, model, tokenizer, generation_config)
+    labels, batched_time = align_sample(samples, args.arranged_path, model, tokenizer, generation_config,
+                                        batch_size=args.batch_size, question_mode=args.question_mode)
+    agreement, by_dimension, mismatches = compare(reference, labels)
+
+    result = {"images": sum(len(names) for names in samples.values()), "labels": len(reference),
+              "batch_size": args.batch_size, "question_mode": args.question_mode,
+              "sequential_s": sequential_time, "batched_s": batched_time,
+              "speedup": sequential_time / batched_time, "agreement": agreement,
+              **{f"{dimension}_agreement": value for dimension, value in by_dimension.items()},
+              "mismatches": len(mismatches)}
+    for metric, value in result.items():
+        print(f"{metric:<16}{value:>12.3f}" if isinstance(value, float) else f"{metric:<16}{value:>12}")
+    for key, stem, side, prompt in mismatches[:20]:
+        print(f"mismatch {key}/{stem} {side}: {reference[(key, stem, side, prompt)]} -> "
+              f"{labels.get((key, stem, side, prompt))} ({prompt[:60]})")
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(result, file, indent=4)
@@ -0,0 +1,139 @@
+import argparse
+import asyncio
+import base64
+import random
+import uuid
+
+from aiohttp import web
+
+# 1x1 white PNG served by /view
+PNG_BYTES = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAIAAACQd1PeAAAADElEQVR4nGP4//8/AAX+Av4N70a4AAAAAElFTkSuQmCC")
+
+
+def find_save_node(prompt):
+    for node_id, node in prompt.items():
+        if "filename_prefix" in node.get("inputs", {}):
+            return node_id, node["inputs"]["filename_prefix"]
+    return "9", "ComfyUI"
+
+
+def find_checkpoints(prompt):
+    return tuple(sorted(node["inputs"]["ckpt_name"] for node in prompt.values() if "ckpt_name" in node.get("inputs", {})))
+
+
+def find_batch_size(prompt):
+    for node in prompt.values():
+        if "batch_size" in node.get("inputs", {}):
+            return int(node["inputs"]["batch_size"])
+    return 1
+
+
+def make_app(exec_time=0.01, latency=0.0, fail_rate=0.0, drop_rate=0.0, swap_time=0.0, seed=None):
+    """A stand-in for one ComfyUI server: one worker runs the queue in order.
+
+    `exec_time` is the render time per image, `latency` is added to every HTTP request,
+    `fail_rate` answers a POST /prompt with 500 and `drop_rate` accepts a prompt and then
+    silently forgets it, like a server restart would. `swap_time` is spent whenever a
+    prompt needs other checkpoints than the one before it.
+    """
+    rng = random.Random(seed)
+    state = {"queue": [], "running": None, "history": {}, "number": 0, "counters": {}, "work": asyncio.Event(),
+             "checkpoints": None, "swaps": 0}
+
+    async def run_queue(app):
+        while True:
+            if not state["queue"]:
+                state["work"].clear()
+                await state["work"].wait()
+                continue
+            number, prompt_id, prompt = state["queue"].pop(0)
+            state["running"] = (number, prompt_id)
+            batch_size = find_batch_size(prompt)
+            checkpoints = find_checkpoints(prompt)
+            if checkpoints != state["checkpoints"]:
+                state["checkpoints"] = checkpoints
+                state["swaps"] += 1
+                await asyncio.sleep(swap_time)
+            await asyncio.sleep(exec_time * batch_size)
+            state["running"] = None
+            node_id, prefix = find_save_node(prompt)
+            images = []
+            for _ in range(batch_size):
+                counter = state["counters"].get(prefix, 0) + 1
+                state["counters"][prefix] = counter
+                images.append({"filename": f"{prefix}_{counter:05d}_.png", "subfolder": "", "type": "output"})
+            state["history"][prompt_id] = {
+                "prompt": [number, prompt_id, {}, {}, [node_id]],
+                "outputs": {node_id: {"images": images}},
+                "status": {"status_str": "success", "completed": True, "messages": []},
+            }
+
+    async def start_worker(app):
+        app["worker"] = asyncio.create_task(run_queue(app))
+
+    async def stop_worker(app):
+        app["worker"].cancel()
+
+    @web.middleware
+    async def add_latency(request, handler):
+        if latency:
+            await asyncio.sleep(latency)
+        return await handler(request)
+
+    async def post_prompt(request):
+        body = await request.json()
+        if rng.random() < fail_rate:
+            return web.json_response({"error": "injected failure"}, status=500)
+        state["number"] += 1
+        prompt_id = str(uuid.uuid4())
+        if rng.random() >= drop_rate:
+            state["queue"].append((state["number"], prompt_id, body["prompt"]))
+            state["work"].set()
+        return web.json_response({"prompt_id": prompt_id, "number": state["number"], "node_errors": {}})
+
+    async def get_queue(request):
+        running = [[state["running"][0], state["running"][1], {}, {}, []]] if state["running"] else []
+        pending = [[number, prompt_id, {}, {}, []] for number, prompt_id, _ in state["queue"]]
+        return web.json_response({"queue_running": running, "queue_pending": pending})
+
+    async def get_history(request):
+        prompt_id = request.match_info.get("prompt_id")
+        if prompt_id is None:
+            return web.json_response(state["history"])
+        entry = state["history"].get(prompt_id)
+        return web.json_response({prompt_id: entry} if entry else {})
+
+    async def get_view(request):
+        if "filename" not in request.query:
+            return web.Response(status=400)
+        return web.Response(body=PNG_BYTES, content_type="image/png")
+
+    app = web.Application(middlewares=[add_latency])
+    app.router.add_post("/prompt", post_prompt)
+    app.router.add_get("/queue", get_queue)
+    app.router.add_get("/history", get_history)
+    app.router.add_get("/history/{prompt_id}", get_history)
+    app.router.add_get("/view", get_view)
+    app.on_startup.append(start_worker)
+    app.on_cleanup.append(stop_worker)
+    app["state"] = state
+    return app
+
+
+def serve(port, host="127.0.0.1", **options):
+    web.run_app(make_app(**options), host=host, port=port, print=None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock ComfyUI server for testing and benchmarking the generation client")
+    parser.add_argument("--port", type=int, default=8190)
+    parser.add_argument("--exec-time", type=float, default=0.01, help="seconds per rendered image")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of POST /prompt answered with 500")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="fraction of accepted prompts never executed")
+    parser.add_argument("--swap-time", type=float, default=0.0, help="seconds to load a different checkpoint")
+    args = parser.parse_args()
+    print(f"Mock ComfyUI listening on http://127.0.0.1:{args.port}/prompt")
+    serve(args.port, exec_time=args.exec_time, latency=args.latency, fail_rate=args.fail_rate, drop_rate=args.drop_rate,
+          swap_time=args.swap_time)
@@ -0,0 +1,17 @@
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark.internViT_pkg.internvl_multi_v import reduce_alignment
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge the counts of partial alignment runs into one align_<model>.json")
+    parser.add_argument("paths", nargs="+", help="checkpoint_<model>.jsonl logs or counts_<model>.json files")
+    parser.add_argument("--output-path", default="./aligned/lcm")
+    parser.add_argument("--model", default="lcm")
+    args = parser.parse_args()
+
+    output_path, counts = reduce_alignment(args.paths, args.output_path, args.model)
+    print(f"Ratios of {len(counts)} prompts from {len(args.paths)} partial results have been saved to {output_path}")
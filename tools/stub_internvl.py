@@ -0,0 +1,283 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark.generate.store import ImageStore
+from benchmark.internViT_pkg.internvl_multi_v import align_worker, process_images_in_directory, reduce_queue
+from benchmark.internViT_pkg.work_queue import WorkQueue
+
+SPECIAL_TOKENS = ["<|system|>", "<|user|>", "<|assistant|>", "<|end|>", "<img>", "</img>", "<IMG_CONTEXT>", "<pad>"]
+
+# what the stub answers, picked by a hash of the prompt and the image features
+ANSWERS = ["male", "female", "White", "Black", "East Asian", "South Asian", "unknown", "0-30 years old",
+           "30-60 years old", "more than 60 years old",
+           "the left person is male and the right person is female",
+           "the left person is Black and the right person is White",
+           "the left person is 0-30 years old and the right person is more than 60 years old"]
+
+
+class Conversation:
+    """The phi3-chat template of InternVL's remote code, enough for build_query."""
+
+    def __init__(self):
+        self.system_message = ""
+        self.roles = ("<|user|>\n", "<|assistant|>\n")
+        self.sep = "<|end|>"
+        self.messages = []
+
+    def append_message(self, role, message):
+        self.messages.append((role, message))
+
+    def get_prompt(self):
+        prompt = "<|system|>\n" + self.system_message + self.sep
+        for role, message in self.messages:
+            prompt += role + (message + self.sep if message is not None else "")
+        return prompt
+
+
+def get_conv_template(name):
+    return Conversation()
+
+
+class Encoding(dict):
+    __getattr__ = dict.__getitem__
+
+
+class StubTokenizer:
+    """One token per Latin-1 character plus InternVL's special tokens.
+
+    The vocab is fixed up front, so every worker process gives a text the same ids and
+    "score" mode the same logits; other characters become "?".
+    """
+
+    def __init__(self):
+        self.tokens = dict(enumerate(SPECIAL_TOKENS + [chr(i) for i in range(256)]))
+        self.vocab = {token: i for i, token in self.tokens.items()}
+        self.padding_side = "right"
+        self.pad_token_id = self.vocab["<pad>"]
+
+    def convert_tokens_to_ids(self, token):
+        return self.vocab.get(token, self.vocab["?"])
+
+    def encode(self, text):
+        ids = []
+        for part in re.split("(" + "|".join(map(re.escape, SPECIAL_TOKENS)) + ")", text):
+            ids.extend([self.convert_tokens_to_ids(part)] if part in SPECIAL_TOKENS else map(self.convert_tokens_to_ids, part))
+        return ids
+
+    def __call__(self, texts, return_tensors=None, padding=False):
+        single = isinstance(texts, str)
+        rows = [self.encode(text) for text in ([texts] if single else texts)]
+        if return_tensors is None:
+            return Encoding(input_ids=rows[0] if single else rows)
+        length = max(map(len, rows))
+        input_ids, attention_mask = [], []
+        for row in rows:
+            pad = length - len(row)
+            left = self.padding_side == "left"
+            input_ids.append([self.pad_token_id] * pad + row if left else row + [self.pad_token_id] * pad)
+            attention_mask.append([0] * pad + [1] * len(row) if left else [1] * len(row) + [0] * pad)
+        return Encoding(input_ids=torch.tensor(input_ids), attention_mask=torch.tensor(attention_mask))
+
+    def batch_decode(self, output, skip_special_tokens=True):
+        return ["".join(self.tokens[i] for i in row if not (skip_special_tokens and i == self.pad_token_id))
+                for row in output.tolist()]
+
+
+class StubLanguageModel(torch.nn.Module):
+    """A small random GRU, so "score" mode gets logits to rank the candidate answers with."""
+
+    def __init__(self, vocab_size=512, hidden_size=16):
+        super().__init__()
+        generator = torch.Generator().manual_seed(0)
+        self.embeddings = torch.nn.Embedding(vocab_size, 1)
+        self.rnn = torch.nn.GRU(1, hidden_size, batch_first=True)
+        self.head = torch.nn.Linear(hidden_size, vocab_size)
+        for parameter in self.parameters():
+            parameter.data = torch.randn(parameter.shape, generator=generator) * 0.5
+
+    def get_input_embeddings(self):
+        return self.embeddings
+
+    def forward(self, inputs_embeds, attention_mask):
+        hidden, _ = self.rnn(inputs_embeds.float())
+        return Encoding(logits=self.head(hidden))
+
+
+class StubConfig:
+    _name_or_path = "stub-internvl"
+    _commit_hash = "0"
+
+    def to_json_string(self):
+        return json.dumps({"template": "phi3-chat"})
+
+
+class StubInternVL:
+    """A CPU stand-in for InternVL's chat model with the methods the alignment stage calls.
+
+    Answers are deterministic in the prompt and the image, so runs split over any number of
+    workers label exactly like one run. `delay` seconds are spent per generate call, like a
+    GPU would.
+    """
+
+    template = "phi3-chat"
+    system_message = "You are a helpful assistant."
+    num_image_token = 2
+    device = torch.device("cpu")
+
+    def __init__(self, tokenizer, delay=0.0):
+        self.tokenizer = tokenizer
+        self.delay = delay
+        self.config = StubConfig()
+        self.language_model = StubLanguageModel()
+        self.img_context_token_id = tokenizer.convert_tokens_to_ids("<IMG_CONTEXT>")
+
+    def extract_feature(self, pixel_values):
+        tile_features = pixel_values.float().flatten(1).mean(1)[:, None, None]
+        return tile_features.repeat(1, self.num_image_token, 1).to(pixel_values.dtype)
+
+    def generate(self, pixel_values, input_ids, attention_mask, visual_features=None, eos_token_id=None, **generation_config):
+        time.sleep(self.delay)
+        features = (visual_features if visual_features is not None else self.extract_feature(pixel_values)).reshape(-1)
+        start = 0
+        outputs = []
+        for row, mask in zip(input_ids, attention_mask):
+            row = row[mask.bool()].tolist()
+            image_tokens = row.count(self.img_context_token_id)
+            image = features[start:start + image_tokens].float()
+            start += image_tokens
+            text = "".join(self.tokenizer.tokens[i] for i in row if i != self.img_context_token_id)
+            digest = hashlib.sha1((text + ",".join(f"{value:.3f}" for value in image.tolist())).encode()).digest()
+            outputs.append(self.tokenizer.encode(ANSWERS[digest[0] % len(ANSWERS)]) + [eos_token_id])
+        length = max(map(len, outputs))
+        return torch.tensor([output + [self.tokenizer.pad_token_id] * (length - len(output)) for output in outputs])
+
+    def chat(self, tokenizer, pixel_values, question, generation_config, history=None, return_history=False):
+        # model.chat of InternVL's modeling_internvl_chat.py for one image
+        if history is None and "<image>" not in question:
+            question = "<image>\n" + question
+        template = get_conv_template(self.template)
+        template.system_message = self.system_message
+        history = [] if history is None else history
+        for old_question, old_answer in history:
+            template.append_message(template.roles[0], old_question)
+            template.append_message(template.roles[1], old_answer)
+        template.append_message(template.roles[0], question)
+        template.append_message(template.roles[1], None)
+        image_tokens = "<img>" + "<IMG_CONTEXT>" * self.num_image_token * pixel_values.shape[0] + "</img>"
+        model_inputs = tokenizer(template.get_prompt().replace("<image>", image_tokens, 1), return_tensors="pt")
+        generation_config["eos_token_id"] = tokenizer.convert_tokens_to_ids(template.sep)
+        output = self.generate(pixel_values, model_inputs["input_ids"], model_inputs["attention_mask"], **generation_config)
+        response = tokenizer.batch_decode(output)[0].split(template.sep)[0].strip()
+        history.append((question, response))
+        return (response, history) if return_history else response
+
+
+def load_stub_model(delay=0.0):
+    """Drop-in for load_model: (model, tokenizer, generation_config)."""
+    tokenizer = StubTokenizer()
+    return StubInternVL(tokenizer, delay), tokenizer, dict(num_beams=1, max_new_tokens=512, do_sample=False)
+
+
+def run_worker(worker_id, queue_path, arranged_path, output_path, lease_time, delay, options):
+    align_worker(queue_path, arranged_path, output_path, "stub", worker_id=worker_id, lease_time=lease_time,
+                 poll_interval=lease_time / 4, model=load_stub_model(delay), **options)
+
+
+def run_workers(arranged_path, output_path, workers, lease_time, delay, kill_after=None, **options):
+    """Align `arranged_path` with `workers` processes sharing one queue, killing the first after `kill_after` seconds."""
+    os.makedirs(output_path, exist_ok=True)
+    queue_path = os.path.join(output_path, "queue.sqlite")
+    processes = [multiprocessing.Process(target=run_worker, args=(f"w{i}", queue_path, arranged_path, output_path,
+                                                                  lease_time, delay, options)) for i in range(workers)]
+    start_time = time.perf_counter()
+    for process in processes:
+        process.start()
+    if kill_after is not None:
+        time.sleep(kill_after)
+        processes[0].kill()
+        print(f"Killed worker w0 after {kill_after}s")
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start_time
+    with WorkQueue(queue_path) as queue:
+        done = queue.done()
+    output_stats, summary = reduce_queue(queue_path, output_path, "stub")
+    with open(output_stats, "r") as file:
+        return json.load(file), done, summary, elapsed
+
+
+def check_reuse(work_path, batch_size=1, distinct=6, copies=2, near_copies=6):
+    """Align a prompt folder with exact and near copies stored through ImageStore, as dir_build does,
+    and return (reused responses, near-duplicate reuse rows, expected for both)."""
+    rng = np.random.default_rng(0)
+    store = ImageStore(os.path.join(work_path, "store"))
+    key = "a photo of one doctor"
+    os.makedirs(os.path.join(work_path, "arranged", key))
+    # smooth images, so a few changed pixels keep the dHash of a near copy within max_distance
+    images = [Image.fromarray(rng.integers(0, 256, (8, 9, 3), dtype=np.uint8)).resize((288, 256), Image.BICUBIC)
+              for _ in range(distinct)]
+    files = [(f"a{i}.png", image) for i, image in enumerate(images)]
+    files += [(f"b{i}.png", images[0]) for i in range(copies)]
+    for i in range(near_copies):
+        near = np.array(images[1])
+        near[i * 4:i * 4 + 2, :2] ^= 1 + i
+        files.append((f"c{i}.png", Image.fromarray(near)))
+    for name, image in files:
+        source_path = os.path.join(work_path, name)
+        image.save(source_path)
+        digest, object_path, _ = store.add_file(source_path, key)
+        store.place(digest, object_path, os.path.join(work_path, "arranged", key, name), key)
+    model, tokenizer, generation_config = load_stub_model()
+    responses = process_images_in_directory(os.path.join(work_path, "arranged", key), model, tokenizer, generation_config,
+                                            sorted(name for name, _ in files), store=store, batch_size=batch_size)[0]
+    reused = sum(1 for response in responses if "reused_from" in response)
+    reuse_rows = store.connection.execute("SELECT COUNT(*) FROM reuse").fetchone()[0]
+    store.close()
+    return reused, reuse_rows, (copies + near_copies, near_copies)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Align an arranged tree with several queue workers and a stub model on the CPU, "
+                                                 "and check the merged ratios against a single worker")
+    parser.add_argument("--arranged-path", default="./arranged/lcm")
+    parser.add_argument("--output-path", default=None, help="kept for inspection, a temporary directory by default")
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--lease-time", type=float, default=2.0)
+    parser.add_argument("--delay", type=float, default=0.02, help="seconds per generate call")
+    parser.add_argument("--kill-after", type=float, default=None, help="kill worker w0 after this many seconds")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--question-mode", default="history")
+    parser.add_argument("--check-reuse", action="store_true",
+                        help="instead, check that copies and near copies in one prompt folder reuse the labels of the first one")
+    args = parser.parse_args()
+
+    if args.check_reuse:
+        with tempfile.TemporaryDirectory() as temp_path:
+            reused, reuse_rows, expected = check_reuse(temp_path, args.batch_size)
+        print(f"{reused} responses reused labels, {reuse_rows} near-duplicate reuse rows, expected {expected[0]} and {expected[1]}")
+        sys.exit(0 if (reused, reuse_rows) == expected else 1)
+
+    options = dict(batch_size=args.batch_size, question_mode=args.question_mode)
+    with tempfile.TemporaryDirectory() as temp_path:
+        output_path = args.output_path or temp_path
+        single, _, _, single_time = run_workers(args.arranged_path, os.path.join(output_path, "single"), 1,
+                                                args.lease_time, args.delay, **options)
+        shared, done, summary, shared_time = run_workers(args.arranged_path, os.path.join(output_path, "shared"), args.workers,
+                                                         args.lease_time, args.delay, args.kill_after, **options)
+    workers = {worker: list(done.values()).count(worker) for worker in sorted(set(done.values()))}
+    print(f"1 worker: {single_time:.1f}s, {args.workers} workers: {shared_time:.1f}s, prompts per worker {workers}, queue {summary}")
+    print("Merged ratios match the single worker" if shared == single else "Merged ratios differ from the single worker")
+    sys.exit(0 if shared == single else 1)